@@ -6,4 +6,6 @@ __all__ = ["block_data_msg", "chunk_bulk_msg", "chunk_data_msg",
            "entity_object_meta", "entity_painting_meta", "entity_player_meta",
            "map_block_msg", "map_block_multi_msg", "mine_block_msg",
            "movement_msg", "place_block_msg", "position_msg", "vec3_msg",
-           "health_msg", "inventory_msg", "slot_msg", "slot_multi_msg"]
+           "health_msg", "inventory_msg", "slot_msg", "slot_multi_msg",
+           "map_changes_msg", "map_section_change_msg",
+           "map_block_array_msg"]
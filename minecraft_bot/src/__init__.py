@@ -3,6 +3,8 @@
 __author__ = "Karan Desai"
 
 __all__ = ["action_gen", "action_schemas", "actionsnode", "atomspace_util",
-           "attention_module", "mapnode", "mc_physics_utils", "mc_vis_utils",
-           "opencog_initializer", "perception_module", "ros_perception",
-           "test_actions", "test_mc_bot", "test_visibility", "visnode","grounded_knowledge"]
+           "attention_module", "mapnode", "mc_map_utils", "mc_physics_utils",
+           "mc_region_loader", "mc_vis_utils", "opencog_initializer",
+           "perception_module", "ros_perception", "test_actions",
+           "test_mc_bot", "test_visibility", "visnode", "grounded_knowledge",
+           "mc_chunk_cache", "bench_mapnode"]
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the map server (mapnode.py) without Minecraft or a ROS graph
+
+Synthetic 1.8 chunk, chunk bulk and block messages are fed straight into a
+MinecraftMap, and then block queries are timed. Worlds can be flat, generated
+terrain, or columns replayed from a world save. Results are printed (or
+written with --output) as one JSON document with sorted keys, so runs can be
+diffed and tracked, e.g.
+
+    rosrun minecraft_bot bench_mapnode.py --world terrain --radius 8
+    rosrun minecraft_bot bench_mapnode.py --world region \\
+        --world-dir ../world/terrainworld --output bench.json
+
+All latencies are in microseconds, memory in bytes.
+"""
+
+import roslib
+roslib.load_manifest('minecraft_bot')
+from minecraft_bot.msg import chunk_data_msg, chunk_bulk_msg, \
+    chunk_meta_msg, block_data_msg
+
+from spockbot.mcp import nbt
+from spockbot.mcp.bbuff import BufferUnderflowException
+
+from mapnode import MinecraftMap, DIMENSION_OVERWORLD, STORAGE_NUMPY
+from mc_map_utils import ArrayChunk, ArrayColumn
+from mc_region_loader import RegionLoader
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import zlib
+
+import numpy as np
+
+WORLD_FLAT = 'flat'
+WORLD_TERRAIN = 'terrain'
+WORLD_REGION = 'region'
+
+AIR = 0
+STONE = 1
+GRASS = 2
+DIRT = 3
+BEDROCK = 7
+WATER = 9
+
+SEA_LEVEL = 62
+
+clock = timeit.default_timer
+
+
+def flat_column():
+    """ A superflat column: bedrock, two layers of dirt and grass. """
+
+    chunk = ArrayChunk()
+    chunk.blocks[0] = BEDROCK << 4
+    chunk.blocks[1:3] = DIRT << 4
+    chunk.blocks[3] = GRASS << 4
+    chunk.light_sky[4:] = 15
+
+    column = ArrayColumn()
+    column.chunks[0] = chunk
+    column.biome[:] = 1
+
+    return column
+
+
+def terrain_column(chunk_x, chunk_z, seed):
+    """ Rolling hills of stone, dirt and grass with water below sea level.
+    The same arguments always give the same column.
+    """
+
+    rng = np.random.RandomState(
+        (seed * 1000003 + chunk_x * 7919 + chunk_z * 104729) & 0x7FFFFFFF)
+
+    z, x = np.indices((16, 16))
+    x = x + chunk_x * 16
+    z = z + chunk_z * 16
+
+    height = (64 + 10 * np.sin(x / 23.) + 7 * np.cos(z / 17.) +
+              4 * np.sin((x + z) / 11.) + rng.randint(0, 2, (16, 16)))
+    height = height.astype(np.int64)
+
+    y = np.arange(256).reshape(256, 1, 1)
+    ids = np.where(y < height - 3, STONE,
+                   np.where(y < height, DIRT,
+                            np.where(y == height, GRASS,
+                                     np.where(y <= SEA_LEVEL, WATER, AIR))))
+    ids = ids.astype(np.uint16)
+    ids[0] = BEDROCK
+
+    column = ArrayColumn()
+    column.biome[:] = 1
+
+    for section_y in range(16):
+        section = ids[section_y * 16:section_y * 16 + 16]
+        if not section.any():
+            continue
+
+        chunk = ArrayChunk()
+        chunk.blocks = section << 4
+        chunk.light_sky = np.where(section == AIR, 15, 0).astype(np.uint8)
+        column.chunks[section_y] = chunk
+
+    return column
+
+
+def generate_payloads(world, radius, seed, world_dir=None):
+    """ Returns [(chunk_x, chunk_z, mask, data)] for the columns within
+    radius chunks of the origin (or of the save's spawn point).
+    """
+
+    payloads = []
+
+    if world == WORLD_REGION:
+        loader = RegionLoader(world_dir)
+        spawn_x, spawn_y, spawn_z = loader.get_spawn()
+        center_x, center_z = spawn_x >> 4, spawn_z >> 4
+    else:
+        center_x = center_z = 0
+
+    flat = flat_column().pack_payload() if world == WORLD_FLAT else None
+
+    for chunk_x in range(center_x - radius, center_x + radius + 1):
+        for chunk_z in range(center_z - radius, center_z + radius + 1):
+            if world == WORLD_FLAT:
+                mask, data = flat
+            elif world == WORLD_TERRAIN:
+                mask, data = terrain_column(
+                    chunk_x, chunk_z, seed).pack_payload()
+            else:
+                try:
+                    column = loader.load_column(chunk_x, chunk_z)
+                except (zlib.error, nbt.MalformedFileError, ValueError,
+                        KeyError, BufferUnderflowException):
+                    # damaged chunk, see RegionLoader.preload()
+                    continue
+                if column is None:
+                    continue
+                mask, data = column.pack_payload()
+
+            payloads.append((chunk_x, chunk_z, mask, data))
+
+    return payloads
+
+
+def percentiles(samples):
+    """ Summarizes latencies in seconds as microseconds. """
+
+    us = np.asarray(samples, dtype=np.float64) * 1e6
+
+    return {
+        'count': int(us.size),
+        'mean': round(float(us.mean()), 3),
+        'p50': round(float(np.percentile(us, 50)), 3),
+        'p90': round(float(np.percentile(us, 90)), 3),
+        'p99': round(float(np.percentile(us, 99)), 3),
+        'max': round(float(us.max()), 3),
+    }
+
+
+def rss_bytes():
+    """ Resident set size of this process, or None if /proc is missing. """
+
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def bench_chunks(args, payloads):
+    """ Feeds every column as its own chunk_data message. """
+
+    world = MinecraftMap(DIMENSION_OVERWORLD, args.storage,
+                         max_hot_sections=args.hot_sections)
+    msgs = [chunk_data_msg(chunk_x=chunk_x, chunk_z=chunk_z, continuous=True,
+                           primary_bitmap=mask, data=data)
+            for chunk_x, chunk_z, mask, data in payloads]
+
+    start = clock()
+    for msg in msgs:
+        world.handle_unpack_chunk(msg)
+    elapsed = clock() - start
+
+    return {
+        'chunks': len(msgs),
+        'seconds': round(elapsed, 6),
+        'chunks_per_second': round(len(msgs) / elapsed, 1),
+    }
+
+
+def bench_bulk(args, payloads):
+    """ Feeds the columns as chunk_bulk messages, returns the stats and the
+    loaded map for the query benchmarks.
+    """
+
+    world = MinecraftMap(DIMENSION_OVERWORLD, args.storage,
+                         decode_workers=args.decode_workers,
+                         max_hot_sections=args.hot_sections)
+
+    msgs = []
+    for i in range(0, len(payloads), args.bulk_size):
+        group = payloads[i:i + args.bulk_size]
+        msgs.append(chunk_bulk_msg(
+            sky_light=True,
+            metadata=[chunk_meta_msg(chunk_x=chunk_x, chunk_z=chunk_z,
+                                     primary_bitmap=mask)
+                      for chunk_x, chunk_z, mask, data in group],
+            data=b''.join(data for chunk_x, chunk_z, mask, data in group)))
+
+    rss_before = rss_bytes()
+
+    start = clock()
+    for msg in msgs:
+        world.handle_unpack_bulk(msg)
+    elapsed = clock() - start
+
+    rss_after = rss_bytes()
+    stats = world.get_stats()
+    columns = max(stats['resident_columns'], 1)
+
+    result = {
+        'bulks': len(msgs),
+        'chunks': len(payloads),
+        'seconds': round(elapsed, 6),
+        'chunks_per_second': round(len(payloads) / elapsed, 1),
+        'resident_columns': stats['resident_columns'],
+        'resident_sections': stats['resident_sections'],
+        'resident_bytes': stats['resident_bytes'],
+        'bytes_per_column': stats['resident_bytes'] // columns,
+        'rss_bytes_per_column': None,
+    }
+
+    if rss_before is not None and rss_after is not None:
+        result['rss_bytes_per_column'] = (rss_after - rss_before) // columns
+
+    return result, world
+
+
+def random_coords(rng, payloads, count):
+    """ Picks block coordinates inside the loaded columns. """
+
+    keys = np.array([(chunk_x, chunk_z)
+                     for chunk_x, chunk_z, mask, data in payloads])
+    picks = keys[rng.randint(0, len(keys), count)]
+
+    xs = picks[:, 0] * 16 + rng.randint(0, 16, count)
+    ys = rng.randint(0, 128, count)
+    zs = picks[:, 1] * 16 + rng.randint(0, 16, count)
+
+    return xs, ys, zs
+
+
+def bench_blocks(args, world, payloads, rng):
+    """ Times single block_data updates. """
+
+    xs, ys, zs = random_coords(rng, payloads, args.updates)
+    ids = rng.randint(1, 100, args.updates)
+    msgs = [block_data_msg(x=int(x), y=int(y), z=int(z), data=int(i) << 4)
+            for x, y, z, i in zip(xs, ys, zs, ids)]
+
+    samples = []
+    for msg in msgs:
+        start = clock()
+        world.handle_unpack_block(msg)
+        samples.append(clock() - start)
+
+    result = percentiles(samples)
+    result['updates_per_second'] = round(len(msgs) / sum(samples), 1)
+
+    return result
+
+
+def bench_get_block(args, world, payloads, rng):
+
+    xs, ys, zs = random_coords(rng, payloads, args.queries)
+    coords = list(zip(xs.tolist(), ys.tolist(), zs.tolist()))
+
+    samples = []
+    for x, y, z in coords:
+        start = clock()
+        world.get_block(x, y, z)
+        samples.append(clock() - start)
+
+    return percentiles(samples)
+
+
+def bench_get_blocks(args, world, payloads, rng):
+
+    batches = [random_coords(rng, payloads, args.multi_size)
+               for i in range(args.multi_batches)]
+
+    samples = []
+    for xs, ys, zs in batches:
+        start = clock()
+        world.get_blocks(xs, ys, zs)
+        samples.append(clock() - start)
+
+    result = percentiles(samples)
+    result['batch_size'] = args.multi_size
+    result['blocks_per_second'] = round(
+        args.multi_size * len(batches) / sum(samples), 1)
+
+    return result
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the map server with synthetic chunk streams")
+    parser.add_argument('--world', default=WORLD_TERRAIN,
+                        choices=(WORLD_FLAT, WORLD_TERRAIN, WORLD_REGION))
+    parser.add_argument('--world-dir', default=None,
+                        help="world save to replay with --world region")
+    parser.add_argument('--radius', type=int, default=6,
+                        help="columns around the center to load (chunks)")
+    parser.add_argument('--storage', default=STORAGE_NUMPY)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--bulk-size', type=int, default=10)
+    parser.add_argument('--decode-workers', type=int, default=4)
+    parser.add_argument('--hot-sections', type=int, default=4096)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--multi-size', type=int, default=1000)
+    parser.add_argument('--multi-batches', type=int, default=200)
+    parser.add_argument('--output', default=None,
+                        help="write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    if args.world == WORLD_REGION and not args.world_dir:
+        parser.error("--world region needs --world-dir")
+
+    payloads = generate_payloads(args.world, args.radius, args.seed,
+                                 args.world_dir)
+    if not payloads:
+        parser.error("no columns to load")
+
+    rng = np.random.RandomState(args.seed)
+
+    results = {'config': vars(args)}
+    results['ingest_chunk'] = bench_chunks(args, payloads)
+    results['ingest_bulk'], world = bench_bulk(args, payloads)
+    results['get_block'] = bench_get_block(args, world, payloads, rng)
+    results['get_block_multi'] = bench_get_blocks(args, world, payloads, rng)
+    results['block_update'] = bench_blocks(args, world, payloads, rng)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == "__main__":
+    main()
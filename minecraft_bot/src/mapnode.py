@@ -10,61 +10,274 @@ import roslib
 roslib.load_manifest('minecraft_bot')
 import rospy
 from minecraft_bot.msg import chunk_data_msg, chunk_bulk_msg, chunk_meta_msg, block_data_msg, map_block_msg
+from minecraft_bot.msg import position_msg, vec3_msg
+from minecraft_bot.msg import map_changes_msg, map_section_change_msg
 from minecraft_bot.srv import get_block_srv, get_block_multi_srv
+from minecraft_bot.srv import get_map_stats_srv, get_block_region_srv
+from minecraft_bot.srv import find_nearest_blocks_srv, get_surface_srv
+from minecraft_bot.srv import visible_blocks_srv
+from std_msgs.msg import Empty, Int8
 
 from spockbot.plugins.base import pl_announce
 from spockbot.mcp.bbuff import BoundBuffer
 from spockbot.plugins.tools import smpmap
 from spockbot import mcdata
 
+from mc_map_utils import ArrayChunk, ArrayColumn, BlockIndex, \
+    iter_sections, iter_box_sections, column_nbytes, column_payload_size, \
+    count_occupancy, section_occupancy, exposed_blocks, SECTION_SHAPE, \
+    SECTION_SIZE, SOLID_BLOCKS, OCCUPANCY_AIR, OCCUPANCY_MIXED
+from mc_region_loader import RegionLoader
+from mc_chunk_cache import ChunkCache
+from mc_vis_utils import VisibilityEngine, make_block_msgs, MAX_DIST, \
+    LOD_MAX_DIST, D_PITCH
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import functools
+import heapq
+import numpy as np
+import threading
 import time
 
 DIMENSION_NETHER = -0x01
 DIMENSION_OVERWORLD = 0x00
 DIMENSION_END = 0x01
 
+# largest box get_block_region will answer (blocks), 128x128x128, and
+# longest side; the sizes in the response are uint16
+MAX_REGION_VOLUME = 128 * 128 * 128
+MAX_REGION_SIDE = 4096
+
+# used by find_nearest_blocks when the request leaves radius at 0
+DEFAULT_SEARCH_RADIUS = 64.
+
+# largest area get_surface will answer (blocks), 512x512, and longest side;
+# the sizes in the response are uint16
+MAX_SURFACE_AREA = 512 * 512
+MAX_SURFACE_SIDE = 4096
+
+# chunk storage backends. 'numpy' keeps each section as contiguous arrays
+# (see mc_map_utils.py), 'smpmap' uses spock's ChunkColumn objects
+STORAGE_NUMPY = 'numpy'
+STORAGE_SMPMAP = 'smpmap'
+
+# offsets of a block and of its six neighbours
+BLOCK_AND_FACES = ((0, 0, 0), (-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0),
+                   (0, 0, -1), (0, 0, 1))
+
+
+def writer(method):
+    """ Runs a MinecraftMap method under the map's write lock. """
+
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.write_lock:
+            return method(self, *args, **kwargs)
+
+    return locked
+
+
+def decode_column(job):
+    """ Decodes one column of a chunk bulk. job is (column_type, payload,
+    offset, mask, skylight); runs on the decode workers.
+    """
+
+    column_type, payload, offset, mask, skylight = job
+
+    column = column_type()
+
+    if column_type is ArrayColumn:
+        column.unpack_payload(payload, mask, skylight, True, offset)
+    else:
+        size = column_payload_size(mask, skylight)
+        column.unpack(BoundBuffer(payload[offset:offset + size]), mask,
+                      skylight)
+
+    return column
+
 
 # modified from class 'Dimension' in smpmap.py from spock
 # some functions added, and changed to handle ROS messages
 # will serve as a dynamic (and fast) storage for the current rendered world
 class MinecraftMap(object):
 
-    def __init__(self, dimension):
+    def __init__(self, dimension, storage=STORAGE_NUMPY, memory_budget=0,
+                 keep_radius=2, decode_workers=0, max_hot_sections=0):
+        """ memory_budget is the number of bytes of chunk data to keep
+        resident (0 for no limit). When it is exceeded, least recently used
+        columns are evicted, except those within keep_radius chunks of the
+        bot. decode_workers is the number of threads decoding the columns of
+        chunk bulks (0 decodes them on the calling thread).
+
+        Sections are kept packed until a query first uses them. At most
+        max_hot_sections decoded sections are kept (0 for no limit), the
+        least recently used ones are packed again.
+        """
 
         self.dimension = dimension
+        self.storage = storage
+
+        # columns is only used by writers: the subscribers and the cache
+        # flush timer, which rospy runs on threads of their own, so they
+        # take write_lock in turn (see writer()). Every update ends with
+        # commit(), which publishes a copy of columns as the snapshot that
+        # queries read. Columns and sections in the snapshot are never
+        # changed in place: writers copy them first (see writable_column()),
+        # so a query that pinned a snapshot sees one consistent map, and
+        # queries never wait for writers or the other way round
+        self.write_lock = threading.RLock()
         self.columns = {}
+        self.snapshot = {}
+        self.snapshot_version = 0
+
+        # columns queries mapped from the chunk cache, handed over to
+        # self.columns at the next commit()
+        self.cache_loaded = {}
+
+        if storage == STORAGE_NUMPY:
+            self.column_type = ArrayColumn
+            self.chunk_type = ArrayChunk
+        elif storage == STORAGE_SMPMAP:
+            self.column_type = smpmap.ChunkColumn
+            self.chunk_type = smpmap.Chunk
+        else:
+            raise ValueError("unknown map storage: %s" % storage)
 
-    def handle_unpack_bulk(self, data):
+        self.memory_budget = memory_budget
+        self.keep_radius = keep_radius
 
-        # print "unpacking bulk"
-        skylight = data.sky_light
-        bbuff = BoundBuffer(data.data)
+        # chunk (x, z) the bot is standing in, None until we hear from it
+        self.focus = None
 
-        # print "light: %s: buffer:"%skylight
-        # print bbuff
+        # bookkeeping for eviction, keyed like self.columns
+        self.column_bytes = {}
+        self.last_access = {}
+        self.clock = 0
 
-        for meta in data.metadata:
-            chunk_x = meta.chunk_x
-            chunk_z = meta.chunk_z
-            mask = meta.primary_bitmap
+        self.resident_bytes = 0
+        self.evicted_columns = 0
+        self.unloaded_columns = 0
 
-            # print "unpacking chunk meta x: %d, z: %d, mask: %d"%(chunk_x,
-            # chunk_z, mask)
+        # optional on-disk ChunkCache (mc_chunk_cache.py). Columns missing
+        # from self.columns are mapped from it on first access, and changed
+        # columns are written back to it by flush_cache()
+        self.cache = None
+        self.dirty = set()
 
-            key = (chunk_x, chunk_z)
+        # which sections hold which block types, for find_nearest_blocks
+        if storage == STORAGE_NUMPY:
+            self.block_index = BlockIndex()
+        else:
+            self.block_index = None
+
+        # revision of every section seen so far, keyed by (chunk_x, chunk_z,
+        # section_y). A section's revision changes whenever what get_block
+        # returns for it changes. All revisions come from one counter, so
+        # they keep growing across unloads and reloads
+        self.revisions = {}
+        self.revision = 0
+
+        # highest revision whose blocks are in the snapshot
+        self.committed_revision = 0
+
+        # (revision, air blocks, solid blocks) of sections, filled in by
+        # get_section_occupancy() and kept up to date by block updates
+        self.occupancy = {}
+
+        # (revisions, bits) of sections, filled in by get_section_exposure()
+        # and kept up to date by block updates. revisions are those of the
+        # section and its six neighbours (see exposure_revisions), bits the
+        # exposed_blocks() of the section packed with np.packbits
+        self.exposure = {}
+
+        # changes not handed to on_changes yet: section key -> list of
+        # (x, y, z, data) block changes, or None if the whole section changed
+        self.pending_changes = {}
+
+        # called with the changes of every update, see publish_changes()
+        self.on_changes = None
+
+        # chunk bulk decoding. decode_queue_depth is the number of columns
+        # waiting to be decoded or committed, latencies are in seconds
+        self.decode_workers = decode_workers
+        self.decode_pool = ThreadPool(decode_workers) if decode_workers \
+            else None
+        self.decode_queue_depth = 0
+        self.decode_queue_peak = 0
+        self.decoded_bulks = 0
+        self.decoded_columns = 0
+        self.decode_latency_total = 0.
+        self.decode_latency_max = 0.
+
+        # decoded sections, least recently used first, and the columns whose
+        # memory use changed since the last pack_cold_sections()
+        self.max_hot_sections = max_hot_sections
+        self.hot_sections = OrderedDict()
+        self.hot_lock = threading.Lock()
+        self.touched_columns = set()
+
+    @writer
+    def handle_unpack_bulk(self, data):
+        """ Decodes every column of a chunk bulk, in parallel if there are
+        decode workers, and then swaps them all into the map at once, so
+        queries never see half of a bulk.
+        """
 
-            if key not in self.columns:
-                self.columns[key] = smpmap.ChunkColumn()
+        skylight = data.sky_light
 
-            self.columns[key].unpack(bbuff, mask, skylight)
+        # bulk columns are always complete and stored back to back, so the
+        # bitmaps tell us where each one starts
+        keys = []
+        jobs = []
+        offset = 0
 
+        for meta in data.metadata:
+            size = column_payload_size(meta.primary_bitmap, skylight)
+            keys.append((meta.chunk_x, meta.chunk_z))
+            jobs.append((self.column_type, data.data, offset,
+                         meta.primary_bitmap, skylight))
+            offset += size
+
+        if offset > len(data.data):
+            raise ValueError("chunk bulk holds %d bytes, its metadata needs %d"
+                             % (len(data.data), offset))
+
+        start = time.time()
+        self.decode_queue_depth += len(jobs)
+        self.decode_queue_peak = max(self.decode_queue_peak,
+                                     self.decode_queue_depth)
+
+        try:
+            if self.decode_pool is not None and len(jobs) > 1:
+                columns = self.decode_pool.map(decode_column, jobs)
+            else:
+                columns = [decode_column(job) for job in jobs]
+
+            self.columns.update(zip(keys, columns))
+        finally:
+            self.decode_queue_depth -= len(jobs)
+
+        latency = time.time() - start
+        self.decoded_bulks += 1
+        self.decoded_columns += len(jobs)
+        self.decode_latency_total += latency
+        self.decode_latency_max = max(self.decode_latency_max, latency)
+
+        for key in keys:
+            self.account_column(key)
+
+        self.enforce_budget()
+        self.commit()
+
+    @writer
     def handle_unpack_chunk(self, data):
 
         chunk_x = data.chunk_x
         chunk_z = data.chunk_z
         mask = data.primary_bitmap
         continuous = data.continuous
-        bbuff = BoundBuffer(data.data)
 
         if self.dimension == DIMENSION_OVERWORLD:
             skylight = True
@@ -73,15 +286,454 @@ class MinecraftMap(object):
 
         key = (chunk_x, chunk_z)
 
-        if key not in self.columns:
-            self.columns[key] = smpmap.ChunkColumn()
+        # in 1.8 the server unloads a column by sending it with no sections
+        if continuous and mask == 0:
+            if key in self.columns:
+                self.remove_column(key)
+                self.unloaded_columns += 1
+                self.commit()
+            return
+
+        # a continuous chunk replaces the whole column, otherwise only the
+        # sections in the bitmap change
+        column = None if continuous else self.writable_column(
+            chunk_x, chunk_z)
 
-        self.columns[key].unpack(bbuff, mask, skylight, continuous)
+        if column is None:
+            column = self.column_type()
+            self.columns[key] = column
+
+        if self.storage == STORAGE_NUMPY:
+            # sections are views straight into the message buffer
+            column.unpack_payload(data.data, mask, skylight, continuous)
+        else:
+            column.unpack(BoundBuffer(data.data), mask, skylight, continuous)
+
+        self.account_column(key, mask=0xFFFF if continuous else mask)
+        self.enforce_budget()
+        self.commit()
 
         # print "unpacking chunk full x: %d, z: %d, mask: %d, cont: %s"%(chunk_x, chunk_z, mask, continuous)
         # print "light: %d, buffer:"%skylight
         # print bbuff
 
+    def get_column(self, x, z):
+        """ Returns the column at chunk coordinates (x, z), mapping it from
+        the chunk cache if it is not resident. Returns None if the column is
+        unknown. Writers only, queries use view_column().
+        """
+
+        column = self.columns.get((x, z))
+
+        if column is None and self.cache is not None:
+            column = self.cache_loaded.pop((x, z), None)
+            if column is None and self.cache.has(self.dimension, x, z):
+                column = self.cache.load(self.dimension, x, z)
+
+            if column is not None:
+                self.columns[(x, z)] = column
+                self.account_column((x, z), changed=False)
+
+        return column
+
+    def view_column(self, snapshot, x, z):
+        """ Returns the column at chunk coordinates (x, z) in a pinned
+        snapshot. Columns only found in the chunk cache are mapped without
+        touching the writers' state, apart from the block index.
+        """
+
+        column = snapshot.get((x, z))
+
+        if column is None and self.cache is not None:
+            column = self.cache_loaded.get((x, z))
+            if column is None and self.cache.has(self.dimension, x, z):
+                loaded = self.cache.load(self.dimension, x, z)
+                column = self.cache_loaded.setdefault((x, z), loaded)
+                if column is loaded:
+                    self.index_cached_column((x, z), column)
+
+        return column
+
+    def index_cached_column(self, key, column):
+        """ Indexes the sections of a column a query mapped from the chunk
+        cache, so block searches see it before commit() makes it resident.
+        """
+
+        if self.block_index is None:
+            return
+
+        with self.block_index.lock:
+            # a writer that made the column resident has indexed it already
+            if key in self.columns:
+                return
+
+            for y, chunk in enumerate(column.chunks):
+                if chunk is not None:
+                    self.block_index.index_section(
+                        (key[0], key[1], y), chunk.view_blocks())
+
+    def writable_column(self, x, z):
+        """ Returns the column at chunk coordinates (x, z) for changing in
+        place, copying it first if it is part of the published snapshot.
+        Returns None if the column is unknown.
+        """
+
+        column = self.get_column(x, z)
+
+        if (column is not None and self.storage == STORAGE_NUMPY and
+                self.snapshot.get((x, z)) is column):
+            column = column.copy()
+            self.columns[(x, z)] = column
+
+        return column
+
+    def get_or_create_chunk(self, x, y, z):
+        """ Returns the section at chunk coordinates (x, y, z) for changing
+        in place, creating it (and its column) if it has not been received
+        yet, or copying it if it is part of the published snapshot.
+        """
+
+        column = self.writable_column(x, z)
+
+        if column is None:
+            column = self.column_type()
+            self.columns[(x, z)] = column
+
+        chunk = column.chunks[y]
+
+        if chunk is None:
+            chunk = self.chunk_type()
+            column.chunks[y] = chunk
+            self.account_column((x, z), mask=1 << y)
+        elif self.storage == STORAGE_NUMPY:
+            published = self.snapshot.get((x, z))
+            if published is not None and published.chunks[y] is chunk:
+                chunk = chunk.copy()
+                column.chunks[y] = chunk
+                self.update_column_bytes((x, z))
+
+        return chunk
+
+    def handle_position_update(self, data):
+
+        self.focus = (int(data.x) >> 4, int(data.z) >> 4)
+
+    @writer
+    def handle_world_reset(self, data=None):
+
+        for key in list(self.columns):
+            self.remove_column(key)
+
+        self.commit()
+
+    @writer
+    def handle_new_dimension(self, data):
+        """ Switches to the dimension the bot joined or respawned in. The
+        columns of the old dimension are dropped (and saved to the chunk
+        cache), and the cache is read for the new dimension from then on.
+        """
+
+        if data.data == self.dimension:
+            return
+
+        for key in list(self.columns):
+            self.remove_column(key)
+
+        # columns queries mapped from the cache belong to the old dimension
+        for key in list(self.cache_loaded):
+            del self.cache_loaded[key]
+            if self.block_index is not None:
+                for y in range(16):
+                    self.block_index.remove_section((key[0], key[1], y))
+
+        self.dimension = data.data
+
+        # every section we know may hold other blocks now
+        for key in list(self.revisions):
+            self.record_change(key)
+
+        self.commit()
+
+    @writer
+    def remove_column(self, key):
+        """ Drops a column and all of its bookkeeping. Unsaved changes are
+        written to the chunk cache first. Without a cache the column's
+        sections are gone for good, so that is recorded as a change.
+        """
+
+        if key in self.dirty:
+            self.flush_cache([key])
+
+        if self.cache is None:
+            for y, chunk in enumerate(self.columns[key].chunks):
+                if chunk is not None:
+                    self.record_change((key[0], key[1], y))
+
+        del self.columns[key]
+        self.resident_bytes -= self.column_bytes.pop(key, 0)
+        self.last_access.pop(key, None)
+
+        with self.hot_lock:
+            for y in range(16):
+                self.hot_sections.pop((key[0], key[1], y), None)
+            self.touched_columns.discard(key)
+
+        if self.block_index is not None:
+            for y in range(16):
+                self.block_index.remove_section((key[0], key[1], y))
+
+        for y in range(16):
+            self.occupancy.pop((key[0], key[1], y), None)
+            self.exposure.pop((key[0], key[1], y), None)
+
+    def account_column(self, key, changed=True, mask=0xFFFF):
+        """ Updates the memory use and access time recorded for a column after
+        it has been created or changed. mask selects the sections that
+        changed; changed=False means the column was only mapped back in from
+        the chunk cache.
+        """
+
+        self.update_column_bytes(key)
+
+        self.clock += 1
+        self.last_access[key] = self.clock
+
+        if self.storage == STORAGE_NUMPY:
+            self.columns[key].update_surface()
+
+        for y, chunk in enumerate(self.columns[key].chunks):
+            if not mask & (1 << y):
+                continue
+
+            section = (key[0], key[1], y)
+
+            if self.block_index is not None:
+                if chunk is None:
+                    self.block_index.remove_section(section)
+                else:
+                    self.block_index.index_section(
+                        section, chunk.view_blocks())
+
+            # sections decoded on arrival (not mapped from the chunk cache)
+            # count as hot until pack_cold_sections() sees them
+            if self.storage == STORAGE_NUMPY:
+                with self.hot_lock:
+                    self.hot_sections.pop(section, None)
+                    if changed and chunk is not None and not chunk.packed:
+                        self.hot_sections[section] = chunk
+
+            if changed:
+                if chunk is not None or section in self.revisions:
+                    self.record_change(section)
+            elif chunk is not None and section not in self.revisions:
+                # first time we see this section since the map started. It is
+                # published like any change, so vision engines caching by
+                # revision learn about it (see VisibilityEngine.marked_revision)
+                self.record_change(section)
+
+        if changed:
+            self.mark_dirty(key)
+
+    @writer
+    def commit(self):
+        """ Publishes the current columns as the snapshot queries read, and
+        the changes queued since the last commit. Queries that pinned an
+        older snapshot keep using it until they finish.
+        """
+
+        for key in list(self.cache_loaded):
+            column = self.cache_loaded.pop(key)
+            if key not in self.columns:
+                self.columns[key] = column
+                self.account_column(key, changed=False)
+
+        self.snapshot = dict(self.columns)
+        self.snapshot_version += 1
+        self.committed_revision = self.revision
+
+        self.publish_changes()
+
+    def update_column_bytes(self, key):
+
+        nbytes = column_nbytes(self.columns[key])
+        self.resident_bytes += nbytes - self.column_bytes.get(key, 0)
+        self.column_bytes[key] = nbytes
+
+    def touch_section(self, key, chunk):
+        """ Marks a section as used by a query, decoding it if it is packed.
+        Safe to call from service threads.
+        """
+
+        chunk.decode()
+
+        with self.hot_lock:
+            self.hot_sections.pop(key, None)
+            self.hot_sections[key] = chunk
+            self.touched_columns.add(key[:2])
+
+    def pack_cold_sections(self):
+        """ Packs the least recently used decoded sections beyond
+        max_hot_sections and brings the memory use of changed columns up to
+        date. Only called by writers, so a section is never packed while a
+        writer holds its arrays. Returns the number of sections packed.
+        """
+
+        cold = []
+        with self.hot_lock:
+            columns = self.touched_columns
+            self.touched_columns = set()
+            while (self.max_hot_sections and
+                   len(self.hot_sections) > self.max_hot_sections):
+                cold.append(self.hot_sections.popitem(last=False))
+
+        for key, chunk in cold:
+            chunk.pack()
+            columns.add(key[:2])
+
+        for key in columns:
+            if key in self.columns:
+                self.update_column_bytes(key)
+
+        return len(cold)
+
+    def record_change(self, key, block=None):
+        """ Gives a section a new revision and queues the change for
+        publish_changes(). block is the (x, y, z, data) of a single changed
+        block, or None if the whole section changed.
+        """
+
+        self.revision += 1
+        self.revisions[key] = self.revision
+
+        if block is None:
+            self.pending_changes[key] = None
+        else:
+            blocks = self.pending_changes.setdefault(key, [])
+            if blocks is not None:
+                blocks.append(block)
+
+    def get_revision(self, chunk_x, chunk_z, section_y):
+        """ Returns the revision of a section, 0 if it has never been seen. """
+
+        return self.revisions.get((chunk_x, chunk_z, section_y), 0)
+
+    def publish_changes(self):
+        """ Hands the changes queued since the last call to on_changes, as
+        a list of (section key, revision, blocks) sorted by section, where
+        blocks is a list of (x, y, z, data) or None if the whole section
+        changed. Returns the list.
+        """
+
+        if not self.pending_changes:
+            return []
+
+        changes = [(key, self.revisions[key], blocks)
+                   for key, blocks in sorted(self.pending_changes.items())]
+        self.pending_changes = {}
+
+        if self.on_changes is not None:
+            self.on_changes(changes)
+
+        return changes
+
+    def mark_dirty(self, key):
+
+        if self.cache is not None:
+            self.dirty.add(key)
+
+    @writer
+    def attach_cache(self, cache):
+        """ Starts serving columns from (and saving them to) a ChunkCache. """
+
+        if self.storage != STORAGE_NUMPY:
+            raise ValueError("the chunk cache needs the numpy map storage")
+
+        self.cache = cache
+
+    @writer
+    def flush_cache(self, keys=None):
+        """ Writes changed columns (or only the given ones) to the chunk
+        cache. Returns the number of columns written.
+        """
+
+        if self.cache is None:
+            return 0
+
+        if keys is None:
+            keys = list(self.dirty)
+
+        written = 0
+        for key in keys:
+            self.dirty.discard(key)
+            column = self.columns.get(key)
+            if column is not None:
+                self.cache.store(self.dimension, key[0], key[1], column)
+                written += 1
+
+        return written
+
+    def chunk_distance(self, key):
+
+        if self.focus is None:
+            return 0
+
+        return max(abs(key[0] - self.focus[0]), abs(key[1] - self.focus[1]))
+
+    def enforce_budget(self):
+        """ Evicts columns until resident chunk data fits in the memory budget
+        (with 10% headroom, so we do not evict on every new chunk). Returns the
+        number of columns evicted.
+        """
+
+        self.pack_cold_sections()
+
+        if not self.memory_budget or self.resident_bytes <= self.memory_budget:
+            return 0
+
+        target = self.memory_budget * 0.9
+
+        # least recently used first, farthest from the bot breaks ties
+        candidates = [key for key in self.columns
+                      if self.focus is None or
+                      self.chunk_distance(key) > self.keep_radius]
+        candidates.sort(key=lambda key: (self.last_access.get(key, 0),
+                                         -self.chunk_distance(key)))
+
+        evicted = 0
+        for key in candidates:
+            if self.resident_bytes <= target:
+                break
+            self.remove_column(key)
+            evicted += 1
+
+        self.evicted_columns += evicted
+        return evicted
+
+    def get_stats(self):
+
+        snapshot = self.snapshot
+
+        return {
+            'resident_columns': len(snapshot),
+            'resident_sections': sum(
+                1 for column in snapshot.values()
+                for chunk in column.chunks if chunk is not None),
+            'resident_bytes': self.resident_bytes,
+            'hot_sections': len(self.hot_sections),
+            'memory_budget': self.memory_budget,
+            'evicted_columns': self.evicted_columns,
+            'unloaded_columns': self.unloaded_columns,
+            'decode_workers': self.decode_workers,
+            'decode_queue_depth': self.decode_queue_depth,
+            'decode_queue_peak': self.decode_queue_peak,
+            'decoded_columns': self.decoded_columns,
+            'decode_latency_mean': (
+                self.decode_latency_total / self.decoded_bulks
+                if self.decoded_bulks else 0.),
+            'decode_latency_max': self.decode_latency_max,
+        }
+
+    @writer
     def handle_unpack_block(self, data):
 
         # becomes (chunk number, offset in chunk)
@@ -89,26 +741,257 @@ class MinecraftMap(object):
         y, ry = divmod(data.y, 16)
         z, rz = divmod(data.z, 16)
 
-        if y > 0x0F:
+        if y < 0 or y > 0x0F:
             return
 
-        if (x, z) in self.columns:
-            column = self.columns[(x, z)]
+        column = self.get_column(x, z)
+        chunk = None if column is None else column.chunks[y]
+
+        if chunk is None:
+            old_data = 0
+        elif self.storage == STORAGE_NUMPY:
+            self.touch_section((x, z, y), chunk)
+            old_data = int(chunk.blocks[ry, rz, rx])
         else:
-            column = smpmap.ChunkColumn()
-            self.columns[(x, z)] = column
+            old_data = chunk.block_data.get(rx, ry, rz)
 
-        chunk = column.chunks[y]
+        # the server often resends blocks that did not change; checked before
+        # the section is copied for writing
+        if old_data == data.data:
+            self.commit()
+            return
 
-        if chunk is None:
-            chunk = smpmap.Chunk()
-            column.chunks[y] = chunk
+        chunk = self.get_or_create_chunk(x, y, z)
 
-        chunk.block_data.set(rx, ry, rz, data.data)
+        if self.storage == STORAGE_NUMPY:
+            self.touch_section((x, z, y), chunk)
+            chunk.blocks[ry, rz, rx] = data.data
+            self.block_index.update_block(
+                (x, z, y), old_data >> 4, data.data >> 4)
+            self.columns[(x, z)].update_surface_at(rx, data.y, rz)
+        else:
+            chunk.block_data.set(rx, ry, rz, data.data)
+
+        occupancy = self.occupancy.get((x, z, y))
+        old_revision = self.revisions.get((x, z, y), 0)
+        exposure = self.exposure_around(data.x, data.y, data.z)
+        self.record_change((x, z, y), (data.x, data.y, data.z, data.data))
+        self.update_exposure(data.x, data.y, data.z, exposure)
+
+        if occupancy is not None and occupancy[0] == old_revision:
+            # counted the blocks just before this update
+            old_id, new_id = old_data >> 4, data.data >> 4
+            self.occupancy[(x, z, y)] = (
+                self.revisions[(x, z, y)],
+                occupancy[1] - (old_id == 0) + (new_id == 0),
+                occupancy[2] - int(SOLID_BLOCKS[old_id]) +
+                int(SOLID_BLOCKS[new_id]))
+        self.mark_dirty((x, z))
+        self.enforce_budget()
+        self.commit()
 
         # print "unpacking block x: %d, y: %d, z: %d, data: %d"%(data.x,
         # data.y, data.z, data.data)
 
+    def get_section_occupancy(self, sections):
+        """ Tells which sections are all air, all solid or mixed. sections
+        is an (n, 3) array of (chunk_x, chunk_z, section_y). Returns an
+        array of OCCUPANCY_* flags; sections that are not loaded, or outside
+        the world, are air.
+        """
+
+        sections = np.asarray(sections, dtype=np.int64).reshape(-1, 3)
+        flags = np.full(len(sections), OCCUPANCY_AIR, dtype=np.uint8)
+
+        if self.storage != STORAGE_NUMPY:
+            flags[:] = OCCUPANCY_MIXED
+            return flags
+
+        # counts are only kept if the snapshot has the blocks of their
+        # revision, see commit()
+        committed = self.committed_revision
+        snapshot = self.snapshot
+
+        for i, key in enumerate(map(tuple, sections.tolist())):
+            if key[2] < 0 or key[2] > 0x0F:
+                continue
+
+            revision = self.revisions.get(key, 0)
+            occupancy = self.occupancy.get(key)
+
+            if occupancy is None or occupancy[0] != revision:
+                column = self.view_column(snapshot, key[0], key[1])
+                chunk = None if column is None else column.chunks[key[2]]
+
+                if chunk is None:
+                    occupancy = (revision, SECTION_SIZE, 0)
+                else:
+                    occupancy = (revision,) + count_occupancy(
+                        chunk.view_blocks())
+
+                if revision <= committed:
+                    self.occupancy[key] = occupancy
+
+            flags[i] = section_occupancy(occupancy[1], occupancy[2])
+
+        return flags
+
+    def exposure_revisions(self, key):
+        """ Returns the revisions the exposure of a section depends on: its
+        own and those of its six neighbours.
+        """
+
+        x, z, y = key
+
+        return tuple(self.revisions.get(neighbour, 0) for neighbour in (
+            (x, z, y), (x - 1, z, y), (x + 1, z, y), (x, z - 1, y),
+            (x, z + 1, y), (x, z, y - 1), (x, z, y + 1)))
+
+    def get_section_exposure(self, key):
+        """ Returns which blocks of the section at key = (chunk_x, chunk_z,
+        section_y) are exposed (see exposed_blocks), as np.packbits of the
+        flags in y, z, x order. Blocks in unloaded sections count as air.
+        Numpy storage only.
+        """
+
+        # masks are only kept if the snapshot has the blocks of their
+        # revisions, see get_section_occupancy()
+        committed = self.committed_revision
+        snapshot = self.snapshot
+
+        revisions = self.exposure_revisions(key)
+        exposure = self.exposure.get(key)
+
+        if exposure is not None and exposure[0] == revisions:
+            return exposure[1]
+
+        chunk_x, chunk_z, section_y = key
+        column = self.view_column(snapshot, chunk_x, chunk_z)
+
+        if column is None or column.chunks[section_y] is None:
+            bits = np.zeros(SECTION_SIZE // 8, dtype=np.uint8)
+        else:
+            x0 = chunk_x * 16 - 1
+            y0 = section_y * 16 - 1
+            z0 = chunk_z * 16 - 1
+            blocks = np.zeros((18, 18, 18), dtype=np.uint16)
+
+            for cx, cz, cy, src, dst in iter_box_sections(
+                    x0, y0, z0, x0 + 17, y0 + 17, z0 + 17):
+                column = self.view_column(snapshot, cx, cz)
+                chunk = None if column is None else column.chunks[cy]
+                if chunk is None:
+                    continue
+
+                self.touch_section((cx, cz, cy), chunk)
+                blocks[dst] = chunk.blocks[src]
+
+            bits = np.packbits(exposed_blocks(blocks))
+
+        if max(revisions) <= committed:
+            self.exposure[key] = (revisions, bits)
+
+        return bits
+
+    def get_exposed(self, xs, ys, zs):
+        """ Tells which of many blocks are exposed, i.e. not air and next to
+        a block that is not solid. Takes block coordinates like get_blocks
+        and returns a bool array in the same order. Blocks buried in solid
+        ones can only be reached through a solid block, so ray casting and
+        region queries can leave everything else out. With smpmap storage
+        every block counts as exposed.
+        """
+
+        xs = np.floor(np.asarray(xs, dtype=np.float64)).astype(np.int64)
+        ys = np.floor(np.asarray(ys, dtype=np.float64)).astype(np.int64)
+        zs = np.floor(np.asarray(zs, dtype=np.float64)).astype(np.int64)
+
+        if self.storage != STORAGE_NUMPY:
+            return np.ones(xs.shape, dtype=bool)
+
+        exposed = np.zeros(xs.shape, dtype=bool)
+
+        for chunk_x, chunk_z, section_y, index in iter_sections(xs, ys, zs):
+            bits = self.get_section_exposure((chunk_x, chunk_z, section_y))
+            i = (((ys[index] & 0x0F) << 8) | ((zs[index] & 0x0F) << 4) |
+                 (xs[index] & 0x0F))
+            exposed[index] = (bits[i >> 3] >> (7 - (i & 7))) & 1
+
+        return exposed
+
+    def exposure_around(self, x, y, z):
+        """ Returns the up to date exposure masks of the sections holding
+        block (x, y, z) and its six neighbours, as a dict from section key to
+        bits. Taken before the block changes, see update_exposure().
+        """
+
+        found = {}
+
+        if not self.exposure:
+            return found
+
+        for dx, dy, dz in BLOCK_AND_FACES:
+            bx, by, bz = x + dx, y + dy, z + dz
+            key = (bx >> 4, bz >> 4, by >> 4)
+            if key in found or by < 0 or by > 255:
+                continue
+
+            exposure = self.exposure.get(key)
+            if (exposure is not None and
+                    exposure[0] == self.exposure_revisions(key)):
+                found[key] = exposure[1]
+
+        return found
+
+    def update_exposure(self, x, y, z, found):
+        """ Brings the masks from exposure_around() up to date after block
+        (x, y, z) changed. Only the block and its six neighbours can change,
+        so only their flags are worked out again.
+        """
+
+        if not found:
+            return
+
+        # the masks may be in use by queries, so they are copied
+        bits = dict((key, value.copy()) for key, value in found.items())
+
+        for dx, dy, dz in BLOCK_AND_FACES:
+            bx, by, bz = x + dx, y + dy, z + dz
+            key = (bx >> 4, bz >> 4, by >> 4)
+            if key not in bits:
+                continue
+
+            exposed = self.block_at(bx, by, bz) >> 4 != 0 and any(
+                not SOLID_BLOCKS[self.block_at(bx + fx, by + fy, bz + fz) >> 4]
+                for fx, fy, fz in BLOCK_AND_FACES[1:])
+
+            i = ((by & 0x0F) << 8) | ((bz & 0x0F) << 4) | (bx & 0x0F)
+            if exposed:
+                bits[key][i >> 3] |= 0x80 >> (i & 7)
+            else:
+                bits[key][i >> 3] &= ~(0x80 >> (i & 7)) & 0xFF
+
+        for key, value in bits.items():
+            self.exposure[key] = (self.exposure_revisions(key), value)
+
+    def block_at(self, x, y, z):
+        """ Returns the block data at (x, y, z) of the columns being written,
+        0 if it is not loaded. Writers only.
+        """
+
+        if y < 0 or y > 255:
+            return 0
+
+        column = self.get_column(x >> 4, z >> 4)
+        chunk = None if column is None else column.chunks[y >> 4]
+
+        if chunk is None:
+            return 0
+
+        self.touch_section((x >> 4, z >> 4, y >> 4), chunk)
+
+        return int(chunk.blocks[y & 0x0F, z & 0x0F, x & 0x0F])
+
     # note, returns block ID and meta in the same byte (data) for consistency
     def get_block(self, x, y, z):
 
@@ -117,34 +1000,278 @@ class MinecraftMap(object):
         y, ry = divmod(y, 16)
         z, rz = divmod(z, 16)
 
-        if (x, z) not in self.columns or y > 0x0F:
+        if y < 0 or y > 0x0F:
+            return 0, 0
+
+        column = self.view_column(self.snapshot, x, z)
+
+        if column is None:
             return 0, 0
 
-        column = self.columns[(x, z)]
+        self.last_access[(x, z)] = self.clock
         chunk = column.chunks[y]
 
         if chunk is None:
             return 0, 0
 
-        data = chunk.block_data.get(rx, ry, rz)
+        if self.storage == STORAGE_NUMPY:
+            self.touch_section((x, z, y), chunk)
+            data = int(chunk.blocks[ry, rz, rx])
+        else:
+            data = chunk.block_data.get(rx, ry, rz)
 
         return data >> 4, data & 0x0F
 
+    def get_blocks(self, xs, ys, zs):
+        """ Looks up many blocks at once. xs, ys and zs are sequences of block
+        coordinates of equal length. Returns two uint16 arrays (block IDs and
+        metadata) in the same order as the input. Blocks in unloaded chunks are
+        returned as air.
+        """
+
+        xs = np.floor(np.asarray(xs, dtype=np.float64)).astype(np.int64)
+        ys = np.floor(np.asarray(ys, dtype=np.float64)).astype(np.int64)
+        zs = np.floor(np.asarray(zs, dtype=np.float64)).astype(np.int64)
+
+        data = np.zeros(xs.shape, dtype=np.uint16)
+
+        if self.storage != STORAGE_NUMPY:
+            for i in range(len(xs)):
+                blockid, meta = self.get_block(xs[i], ys[i], zs[i])
+                data[i] = blockid << 4 | meta
+            return data >> 4, data & 0x0F
+
+        self.clock += 1
+        snapshot = self.snapshot
+
+        for chunk_x, chunk_z, section_y, index in iter_sections(xs, ys, zs):
+            column = self.view_column(snapshot, chunk_x, chunk_z)
+            if column is None:
+                continue
+
+            self.last_access[(chunk_x, chunk_z)] = self.clock
+
+            chunk = column.chunks[section_y]
+            if chunk is None:
+                continue
+
+            self.touch_section((chunk_x, chunk_z, section_y), chunk)
+            data[index] = chunk.blocks[
+                ys[index] & 0x0F, zs[index] & 0x0F, xs[index] & 0x0F]
+
+        return data >> 4, data & 0x0F
+
+    def get_region(self, x0, y0, z0, x1, y1, z1, exposed_only=False):
+        """ Copies the box between block coordinates (x0, y0, z0) and
+        (x1, y1, z1), both inclusive, out of the map. Returns three arrays
+        indexed [y, z, x] relative to the low corner: block data (blockid << 4
+        | metadata, uint16), block light and sky light (uint8). Blocks in
+        unloaded chunks are returned as air with no light. With
+        exposed_only, blocks that are not exposed (see get_exposed) are
+        returned as air too.
+        """
+
+        x0, x1 = sorted((int(x0), int(x1)))
+        y0, y1 = sorted((int(y0), int(y1)))
+        z0, z1 = sorted((int(z0), int(z1)))
+
+        shape = (y1 - y0 + 1, z1 - z0 + 1, x1 - x0 + 1)
+        blocks = np.zeros(shape, dtype=np.uint16)
+        light_block = np.zeros(shape, dtype=np.uint8)
+        light_sky = np.zeros(shape, dtype=np.uint8)
+
+        if self.storage != STORAGE_NUMPY:
+            for y in range(y0, y1 + 1):
+                for z in range(z0, z1 + 1):
+                    for x in range(x0, x1 + 1):
+                        blockid, meta = self.get_block(x, y, z)
+                        i = (y - y0, z - z0, x - x0)
+                        blocks[i] = blockid << 4 | meta
+                        light_block[i], light_sky[i] = self.get_light(x, y, z)
+            return blocks, light_block, light_sky
+
+        self.clock += 1
+        snapshot = self.snapshot
+
+        for chunk_x, chunk_z, section_y, src, dst in iter_box_sections(
+                x0, y0, z0, x1, y1, z1):
+            column = self.view_column(snapshot, chunk_x, chunk_z)
+            if column is None:
+                continue
+
+            self.last_access[(chunk_x, chunk_z)] = self.clock
+
+            chunk = column.chunks[section_y]
+            if chunk is None:
+                continue
+
+            self.touch_section((chunk_x, chunk_z, section_y), chunk)
+            blocks[dst] = chunk.blocks[src]
+            light_block[dst] = chunk.light_block[src]
+            light_sky[dst] = chunk.light_sky[src]
+
+            if exposed_only:
+                exposed = np.unpackbits(self.get_section_exposure(
+                    (chunk_x, chunk_z, section_y))).reshape(SECTION_SHAPE)
+                blocks[dst] *= exposed[src]
+
+        return blocks, light_block, light_sky
+
+    def get_height(self, x, z):
+        """ Returns (y, blockid, metadata) of the topmost solid block at
+        (x, z), or (-1, 0, 0) if the column is not loaded or has no solid
+        block.
+        """
+
+        if self.storage != STORAGE_NUMPY:
+            raise ValueError("the heightmap needs the numpy map storage")
+
+        x, rx = divmod(int(x), 16)
+        z, rz = divmod(int(z), 16)
+
+        column = self.view_column(self.snapshot, x, z)
+
+        if column is None:
+            return -1, 0, 0
+
+        block = int(column.topblock[rz, rx])
+
+        return int(column.heightmap[rz, rx]), block >> 4, block & 0x0F
+
+    def get_surface(self, x0, z0, x1, z1):
+        """ Returns the heightmap and top block data (blockid << 4 |
+        metadata) of the area between (x0, z0) and (x1, z1), both inclusive, as
+        two arrays indexed [z, x] relative to the low corner. Heights are -1
+        where nothing is loaded.
+        """
+
+        if self.storage != STORAGE_NUMPY:
+            raise ValueError("the heightmap needs the numpy map storage")
+
+        x0, x1 = sorted((int(x0), int(x1)))
+        z0, z1 = sorted((int(z0), int(z1)))
+
+        shape = (z1 - z0 + 1, x1 - x0 + 1)
+        heights = np.full(shape, -1, dtype=np.int16)
+        topblocks = np.zeros(shape, dtype=np.uint16)
+        snapshot = self.snapshot
+
+        # a single-section-high box gives us the column intersections
+        for chunk_x, chunk_z, section_y, src, dst in iter_box_sections(
+                x0, 0, z0, x1, 0, z1):
+            column = self.view_column(snapshot, chunk_x, chunk_z)
+            if column is None:
+                continue
+
+            heights[dst[1:]] = column.heightmap[src[1:]]
+            topblocks[dst[1:]] = column.topblock[src[1:]]
+
+        return heights, topblocks
+
+    def find_nearest_blocks(self, blockids, x, y, z, k=1,
+                            radius=DEFAULT_SEARCH_RADIUS):
+        """ Finds up to k blocks whose ID is in blockids, no farther than
+        radius from (x, y, z). Returns a list of (distance, x, y, z, blockid,
+        metadata) tuples, nearest first. Columns in the chunk cache within
+        radius are mapped in first, so they are searched too.
+
+        Sections are visited in order of their distance from the origin, and
+        the search stops once no remaining section can hold a closer block.
+        """
+
+        if self.block_index is None:
+            raise ValueError("block search needs the numpy map storage")
+
+        snapshot = self.snapshot
+        # block IDs have 12 bits, larger ones can never match
+        ids = sorted(set(int(b) for b in blockids if 0 <= int(b) < 4096))
+        origin = np.array([x, y, z], dtype=np.float64)
+
+        wanted = np.zeros(4096, dtype=bool)
+        wanted[ids] = True
+
+        # the index only knows cached columns once they are mapped
+        if self.cache is not None:
+            cx0, cx1 = int((x - radius) // 16), int((x + radius) // 16)
+            cz0, cz1 = int((z - radius) // 16), int((z + radius) // 16)
+            for chunk_x, chunk_z in self.cache.columns(self.dimension):
+                if (cx0 <= chunk_x <= cx1 and cz0 <= chunk_z <= cz1 and
+                        (chunk_x, chunk_z) not in snapshot):
+                    self.view_column(snapshot, chunk_x, chunk_z)
+
+        sections = []
+        for key in self.block_index.sections_with(ids):
+            low = np.array([key[0], key[2], key[1]], dtype=np.float64) * 16
+            gap = np.maximum(np.maximum(low - origin, origin - (low + 15)), 0)
+            bound = np.sqrt(np.dot(gap, gap))
+            if bound <= radius:
+                sections.append((bound, key))
+        heapq.heapify(sections)
+
+        # max-heap (by negated distance) of the best k blocks so far
+        best = []
+
+        while sections:
+            bound, (chunk_x, chunk_z, section_y) = heapq.heappop(sections)
+            if len(best) == k and bound > -best[0][0]:
+                break
+
+            # the index may already know sections the snapshot does not
+            column = self.view_column(snapshot, chunk_x, chunk_z)
+            chunk = None if column is None else column.chunks[section_y]
+            if chunk is None:
+                continue
+
+            self.touch_section((chunk_x, chunk_z, section_y), chunk)
+            data = chunk.blocks.ravel()
+            hits = np.flatnonzero(wanted[data >> 4])
+
+            ry, rz, rx = np.unravel_index(hits, SECTION_SHAPE)
+            bx = rx + chunk_x * 16
+            by = ry + section_y * 16
+            bz = rz + chunk_z * 16
+            dist = np.sqrt((bx - origin[0]) ** 2 + (by - origin[1]) ** 2 +
+                           (bz - origin[2]) ** 2)
+
+            for i in np.argsort(dist, kind='mergesort')[:k]:
+                if dist[i] > radius:
+                    break
+                found = (-float(dist[i]), int(bx[i]), int(by[i]), int(bz[i]),
+                         int(data[hits[i]]))
+                if len(best) < k:
+                    heapq.heappush(best, found)
+                elif found > best[0]:
+                    heapq.heapreplace(best, found)
+                else:
+                    break
+
+        return [(-neg_dist, bx, by, bz, block >> 4, block & 0x0F)
+                for neg_dist, bx, by, bz, block in sorted(best, reverse=True)]
+
     def get_light(self, x, y, z):
 
         x, rx = divmod(x, 16)
         y, ry = divmod(y, 16)
         z, rz = divmod(z, 16)
 
-        if (x, z) not in self.columns or y > 0x0F:
+        if y < 0 or y > 0x0F:
+            return 0, 0
+
+        column = self.view_column(self.snapshot, x, z)
+
+        if column is None:
             return 0, 0
 
-        column = self.columns[(x, z)]
         chunk = column.chunks[y]
 
         if chunk is None:
             return 0, 0
 
+        if self.storage == STORAGE_NUMPY:
+            self.touch_section((x, z, y), chunk)
+            return (int(chunk.light_block[ry, rz, rx]),
+                    int(chunk.light_sky[ry, rz, rx]))
+
         return chunk.light_block.get(
             rx, ry, rz), chunk.light_sky.get(rx, ry, rz)
 
@@ -158,11 +1285,17 @@ class MinecraftMap(object):
         x, rx = divmod(x, 16)
         z, rz = divmod(z, 16)
 
-        if (x, z) not in self.columns:
+        column = self.view_column(self.snapshot, x, z)
+
+        if column is None:
             return 0
 
-        return self.columns[(x, z)].biome.get(rx, rz)
+        if self.storage == STORAGE_NUMPY:
+            return int(column.biome[rz, rx])
+
+        return column.biome.get(rx, rz)
 
+    @writer
     def set_light(self, x, y, z, light_block=None, light_sky=None):
         """ Sets the light level for the block at the given coordinates to the
         specified values.  If light_block or light_sky are not set in the
@@ -175,20 +1308,20 @@ class MinecraftMap(object):
 
         # Check to see if y > 16, i.e. if the original height was greater than
         # 255 and therefore too high to be part of the world.
-        if y > 0x0F:
+        if y < 0 or y > 0x0F:
             return
 
-        if (x, z) in self.columns:
-            column = self.columns[(x, z)]
-        else:
-            column = smpmap.ChunkColumn()
-            self.columns[(x, z)] = column
-
-        chunk = column.chunks[y]
+        chunk = self.get_or_create_chunk(x, y, z)
 
-        if chunk is None:
-            chunk = smpmap.Chunk()
-            column.chunks[y] = chunk
+        if self.storage == STORAGE_NUMPY:
+            self.touch_section((x, z, y), chunk)
+            if light_block is not None:
+                chunk.light_block[ry, rz, rx] = light_block & 0xF
+            if light_sky is not None:
+                chunk.light_sky[ry, rz, rx] = light_sky & 0xF
+            self.mark_dirty((x, z))
+            self.commit()
+            return
 
         if light_block is not None:
             chunk.light_block.set(rx, ry, rz, light_block & 0xF)
@@ -196,16 +1329,24 @@ class MinecraftMap(object):
         if light_sky is not None:
             chunk.light_sky.set(rx, ry, rz, light_sky & 0xF)
 
+    @writer
     def set_biome(self, x, z, data):
 
         x, rx = divmod(x, 16)
         z, rz = divmod(z, 16)
 
-        if (x, z) in self.columns:
-            column = self.columns[(x, z)]
-        else:
-            column = smpmap.ChunkColumn()
+        column = self.writable_column(x, z)
+
+        if column is None:
+            column = self.column_type()
             self.columns[(x, z)] = column
+            self.account_column((x, z))
+
+        if self.storage == STORAGE_NUMPY:
+            column.biome[rz, rx] = data
+            self.mark_dirty((x, z))
+            self.commit()
+            return
 
         return column.biome.set(rx, rz, data)
 
@@ -233,40 +1374,260 @@ def get_block(req):
 
 
 def get_block_multi(req):
-    """ Queries the Minecraft map multiple times (once for each block in the
-    input list) to get the block info for the requested blocks and then returns
-    a dictionary whose 'block' entry contains a list of the requested blocks.
+    """ Queries the Minecraft map for all of the requested blocks at once and
+    then returns a dictionary whose 'blocks' entry contains a list of the
+    requested blocks, in the same order as the request.
+    """
+
+    coords = np.array([(c.x, c.y, c.z) for c in req.coords],
+                      dtype=np.int64).reshape(-1, 3)
+    blockids, metas = world.get_blocks(
+        coords[:, 0], coords[:, 1], coords[:, 2])
+
+    blocks = [map_block_msg(blockid=bid, metadata=meta, x=x, y=y, z=z)
+              for (x, y, z), bid, meta
+              in zip(coords.tolist(), blockids.tolist(), metas.tolist())]
+
+    return {'blocks': blocks}
+
+
+def get_block_region(req):
+    """ Returns every block in the box between req.min and req.max
+    (inclusive) as packed arrays, walking x first, then z, then y. With
+    req.exposed_only, blocks that cannot be seen from anywhere are air.
     """
 
-    blocks = list()
-    for req_msg in req.coords:
-        msg = map_block_msg()
-        msg.x = req_msg.x
-        msg.y = req_msg.y
-        msg.z = req_msg.z
-        msg.blockid, msg.metadata = world.get_block(msg.x, msg.y, msg.z)
-        # print msg
-        blocks.append(msg)
-
-    # print type(blocks)
+    x0, x1 = sorted((req.min.x, req.max.x))
+    y0, y1 = sorted((req.min.y, req.max.y))
+    z0, z1 = sorted((req.min.z, req.max.z))
+
+    volume = (x1 - x0 + 1) * (y1 - y0 + 1) * (z1 - z0 + 1)
+    if volume > MAX_REGION_VOLUME:
+        raise rospy.ServiceException(
+            "region of %d blocks is larger than %d" % (volume,
+                                                       MAX_REGION_VOLUME))
+
+    side = max(x1 - x0, y1 - y0, z1 - z0) + 1
+    if side > MAX_REGION_SIDE:
+        raise rospy.ServiceException(
+            "region side of %d blocks is longer than %d" % (side,
+                                                            MAX_REGION_SIDE))
+
+    blocks, light_block, light_sky = world.get_region(
+        x0, y0, z0, x1, y1, z1, req.exposed_only)
+
+    origin = vec3_msg()
+    origin.x, origin.y, origin.z = x0, y0, z0
+
+    return {'origin': origin,
+            'size_x': x1 - x0 + 1,
+            'size_y': y1 - y0 + 1,
+            'size_z': z1 - z0 + 1,
+            'blockid': (blocks >> 4).ravel().tolist(),
+            'metadata': (blocks & 0x0F).astype(np.uint8).tobytes(),
+            'blocklight': light_block.tobytes(),
+            'skylight': light_sky.tobytes()}
+
+
+def find_nearest_blocks(req):
+    """ Returns the req.k blocks nearest to req.origin whose ID is one of
+    req.blockids, nearest first.
+    """
+
+    found = world.find_nearest_blocks(
+        req.blockids, req.origin.x, req.origin.y, req.origin.z,
+        req.k or 1, req.radius or DEFAULT_SEARCH_RADIUS)
+
+    blocks = [map_block_msg(blockid=blockid, metadata=meta, x=x, y=y, z=z)
+              for dist, x, y, z, blockid, meta in found]
+
     return {'blocks': blocks}
 
 
+def get_surface(req):
+    """ Returns the height and block of the topmost solid block for every
+    (x, z) between the requested corners, walking x first, then z.
+    """
+
+    x0, x1 = sorted((req.min_x, req.max_x))
+    z0, z1 = sorted((req.min_z, req.max_z))
+
+    area = (x1 - x0 + 1) * (z1 - z0 + 1)
+    if area > MAX_SURFACE_AREA:
+        raise rospy.ServiceException(
+            "area of %d blocks is larger than %d" % (area, MAX_SURFACE_AREA))
+
+    side = max(x1 - x0, z1 - z0) + 1
+    if side > MAX_SURFACE_SIDE:
+        raise rospy.ServiceException(
+            "area side of %d blocks is longer than %d" % (side,
+                                                          MAX_SURFACE_SIDE))
+
+    heights, topblocks = world.get_surface(x0, z0, x1, z1)
+
+    return {'origin_x': x0,
+            'origin_z': z0,
+            'size_x': x1 - x0 + 1,
+            'size_z': z1 - z0 + 1,
+            'height': heights.ravel().tolist(),
+            'blockid': (topblocks >> 4).ravel().tolist(),
+            'metadata': (topblocks & 0x0F).astype(np.uint8).tobytes()}
+
+
+def publish_map_changes(changes):
+    """ Sends one batch of section changes from the map on 'map_changes'.
+    """
+
+    msg = map_changes_msg()
+
+    rostime = rospy.Time.now()
+    msg.ROStimestamp = rostime.secs * 10e9 + rostime.nsecs
+
+    for (chunk_x, chunk_z, section_y), revision, blocks in changes:
+        section = map_section_change_msg()
+        section.chunk_x = chunk_x
+        section.chunk_z = chunk_z
+        section.section_y = section_y
+        section.revision = revision
+        section.full = blocks is None
+        section.blocks = [
+            map_block_msg(blockid=data >> 4, metadata=data & 0x0F,
+                          x=x, y=y, z=z)
+            for x, y, z, data in blocks or ()]
+        msg.sections.append(section)
+
+    pub_map_changes.publish(msg)
+
+
+def handle_map_changes(changes):
+    """ Lets the visibility engine re-cast the rays crossing changed blocks,
+    and sends the changes out on 'map_changes'.
+    """
+
+    vision.mark_changed(changes)
+    publish_map_changes(changes)
+
+
+def get_map_stats(req):
+    """ Returns memory use and eviction counters of the map, and the
+    counters of its visibility engine.
+    """
+
+    stats = world.get_stats()
+
+    for name, value in vision.get_stats().items():
+        stats['vision_' + name] = value
+
+    return stats
+
+
+def get_visible_blocks(req):
+    """ Returns the blocks the bot can see from the requested camera pose,
+    so that only the visible set has to leave the map server. With
+    req.packed they are sent as parallel arrays instead of map_block_msgs.
+    """
+
+    voxels, blockids, metas = vision.get_visible(
+        req.x, req.y, req.z, req.pitch, req.yaw)
+
+    if req.packed:
+        return {'x': voxels[:, 0].tolist(),
+                'y': voxels[:, 1].tolist(),
+                'z': voxels[:, 2].tolist(),
+                'blockid': blockids.tolist(),
+                'metadata': metas.tolist()}
+
+    return {'visible_blocks': make_block_msgs(voxels, blockids, metas)}
+
+
 world = MinecraftMap(DIMENSION_OVERWORLD)
+vision = VisibilityEngine(world.get_blocks, get_revision=world.get_revision,
+                          get_occupancy=world.get_section_occupancy,
+                          get_exposed=world.get_exposed)
 
 if __name__ == "__main__":
 
     rospy.init_node('minecraft_map_server')
 
+    world = MinecraftMap(
+        DIMENSION_OVERWORLD,
+        rospy.get_param('~storage', STORAGE_NUMPY),
+        int(rospy.get_param('~memory_budget_mb', 0) * 1024 * 1024),
+        rospy.get_param('~keep_radius', 2),
+        rospy.get_param('~decode_workers', 4),
+        rospy.get_param('~hot_sections', 4096))
+
+    vision_lod = rospy.get_param('~vision_lod', False)
+    vision = VisibilityEngine(
+        world.get_blocks,
+        float(rospy.get_param('~vision_angle_step', D_PITCH)),
+        float(rospy.get_param('~vision_max_dist',
+                              LOD_MAX_DIST if vision_lod else MAX_DIST)),
+        world.get_revision,
+        rospy.get_param('~vision_cache_size', 256),
+        lod=vision_lod,
+        get_occupancy=world.get_section_occupancy,
+        get_exposed=world.get_exposed)
+
+    pub_map_changes = rospy.Publisher(
+        'map_changes', map_changes_msg, queue_size=100)
+    world.on_changes = handle_map_changes
+
+    # serve the world we saw last time until Spock streams it again
+    cache_dir = rospy.get_param('~cache_dir', '')
+    if cache_dir:
+        world.attach_cache(ChunkCache(cache_dir))
+        rospy.Timer(
+            rospy.Duration(rospy.get_param('~cache_flush_period', 5.)),
+            lambda event: world.flush_cache())
+        rospy.on_shutdown(world.flush_cache)
+
+    # optionally warm the map from a world save around its spawn point, so
+    # queries can be answered before Spock has streamed any chunks
+    world_dir = rospy.get_param('~world_dir', '')
+    if world_dir:
+        loader = RegionLoader(world_dir)
+        spawn_x, spawn_y, spawn_z = loader.get_spawn()
+        loaded = loader.preload(world, spawn_x, spawn_z,
+                                rospy.get_param('~preload_radius', 8))
+        rospy.loginfo("preloaded %d chunk columns from %s (%d damaged)",
+                      loaded, world_dir, len(loader.damaged))
+
     rospy.Subscriber('chunk_data', chunk_data_msg, world.handle_unpack_chunk)
     rospy.Subscriber('chunk_bulk', chunk_bulk_msg, world.handle_unpack_bulk)
     rospy.Subscriber('block_data', block_data_msg, world.handle_unpack_block)
+    rospy.Subscriber(
+        'client_position_data',
+        position_msg,
+        world.handle_position_update)
+    rospy.Subscriber('world_reset', Empty, world.handle_world_reset)
+    rospy.Subscriber('dimension', Int8, world.handle_new_dimension)
 
     srv_block = rospy.Service('get_block_data', get_block_srv, get_block)
     srv_block_multi = rospy.Service(
         'get_block_multi',
         get_block_multi_srv,
         get_block_multi)
+    srv_block_region = rospy.Service(
+        'get_block_region',
+        get_block_region_srv,
+        get_block_region)
+    srv_nearest_blocks = rospy.Service(
+        'find_nearest_blocks',
+        find_nearest_blocks_srv,
+        find_nearest_blocks)
+    srv_surface = rospy.Service(
+        'get_surface',
+        get_surface_srv,
+        get_surface)
+    srv_map_stats = rospy.Service(
+        'get_map_stats',
+        get_map_stats_srv,
+        get_map_stats)
+    srv_visible_blocks = rospy.Service(
+        'get_visible_blocks',
+        visible_blocks_srv,
+        get_visible_blocks)
     #srv_light = rospy.Service('get_light_data', light_data_msg, world.getLight)
     #srv_biome = rospy.Service('get_biome_data', biome_data_msg, world.getBiome)
 
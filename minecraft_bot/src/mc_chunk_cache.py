@@ -0,0 +1,181 @@
+"""
+On-disk cache of chunk columns for the map server, so a restarted mapnode can
+answer queries before Spock has streamed the world again
+
+Each column is one fixed-layout file, <cache_dir>/dim<d>/c.<x>.<z>.bin,
+described by COLUMN_DTYPE. Files are opened with np.memmap in copy-on-write
+mode, so loading a column costs nothing until its pages are read, and changes
+made in memory only reach the disk through ChunkCache.store(). Every store
+bumps the column's revision stamp in the file header.
+"""
+
+import os
+import re
+
+import numpy as np
+
+from mc_map_utils import ArrayChunk, ArrayColumn, SECTION_SHAPE
+
+CACHE_MAGIC = b'MCCC'
+CACHE_VERSION = 1
+
+COLUMN_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('revision', '<u8'),
+    ('mask', '<u2'),
+    ('reserved', 'V46'),
+    ('blocks', '<u2', (16,) + SECTION_SHAPE),
+    ('light_block', 'u1', (16,) + SECTION_SHAPE),
+    ('light_sky', 'u1', (16,) + SECTION_SHAPE),
+    ('biome', 'u1', (16, 16)),
+])
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('revision', '<u8'),
+])
+
+COLUMN_FILE = re.compile(r'^c\.(-?\d+)\.(-?\d+)\.bin$')
+
+
+class ChunkCache(object):
+    """ Maps (dimension, chunk_x, chunk_z) to cached ArrayColumns. """
+
+    def __init__(self, cache_dir):
+
+        self.cache_dir = cache_dir
+
+        # (dimension, chunk_x, chunk_z) -> revision of the stored column
+        self.revisions = {}
+
+        self.scan()
+
+    def path(self, dimension, chunk_x, chunk_z):
+
+        return os.path.join(self.cache_dir, 'dim%d' % dimension,
+                            'c.%d.%d.bin' % (chunk_x, chunk_z))
+
+    def scan(self):
+        """ Reads the header of every cached column. Only the headers are
+        touched, so this is cheap even for large caches.
+        """
+
+        self.revisions = {}
+
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        for dim_dir in os.listdir(self.cache_dir):
+            if not dim_dir.startswith('dim'):
+                continue
+
+            try:
+                dimension = int(dim_dir[3:])
+            except ValueError:
+                continue
+
+            for name in os.listdir(os.path.join(self.cache_dir, dim_dir)):
+                match = COLUMN_FILE.match(name)
+                if match is None:
+                    continue
+
+                key = (dimension, int(match.group(1)), int(match.group(2)))
+                path = self.path(*key)
+
+                if os.path.getsize(path) != COLUMN_DTYPE.itemsize:
+                    continue
+
+                header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+                if (header['magic'] == CACHE_MAGIC and
+                        header['version'] == CACHE_VERSION):
+                    self.revisions[key] = int(header['revision'])
+
+    def has(self, dimension, chunk_x, chunk_z):
+
+        return (dimension, chunk_x, chunk_z) in self.revisions
+
+    def columns(self, dimension):
+        """ Returns the (chunk_x, chunk_z) of every cached column of a
+        dimension.
+        """
+
+        return [(chunk_x, chunk_z)
+                for dim, chunk_x, chunk_z in list(self.revisions)
+                if dim == dimension]
+
+    def load(self, dimension, chunk_x, chunk_z):
+        """ Returns the cached column as an ArrayColumn whose arrays are
+        copy-on-write views of the mapped file, with its surface computed, or
+        None if it is not cached.
+        """
+
+        if not self.has(dimension, chunk_x, chunk_z):
+            return None
+
+        record = np.memmap(self.path(dimension, chunk_x, chunk_z),
+                           dtype=COLUMN_DTYPE, mode='c', shape=(1,))
+
+        column = ArrayColumn()
+        column.biome = record['biome'][0]
+        mask = int(record['mask'][0])
+
+        for i in range(16):
+            if mask & (1 << i):
+                chunk = ArrayChunk()
+                chunk.blocks = record['blocks'][0, i]
+                chunk.light_block = record['light_block'][0, i]
+                chunk.light_sky = record['light_sky'][0, i]
+                column.chunks[i] = chunk
+
+        # the heightmap is not stored, queries may read it before the map
+        # gets to account for the column
+        column.update_surface()
+
+        return column
+
+    def store(self, dimension, chunk_x, chunk_z, column):
+        """ Writes a column to the cache, replacing any older entry, and
+        returns its new revision. The file is written next to the old one and
+        renamed over it, so readers never see a partial column.
+        """
+
+        key = (dimension, chunk_x, chunk_z)
+        revision = self.revisions.get(key, 0) + 1
+
+        record = np.zeros(1, dtype=COLUMN_DTYPE)
+        record['magic'] = CACHE_MAGIC
+        record['version'] = CACHE_VERSION
+        record['revision'] = revision
+        record['biome'][0] = column.biome
+
+        mask = 0
+        for i, chunk in enumerate(column.chunks):
+            if chunk is None:
+                continue
+            mask |= 1 << i
+            blocks, light_block, light_sky = chunk.arrays()
+            record['blocks'][0, i] = blocks
+            record['light_block'][0, i] = light_block
+            record['light_sky'][0, i] = light_sky
+        record['mask'] = mask
+
+        path = self.path(*key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(record.tobytes())
+        os.rename(tmp_path, path)
+
+        self.revisions[key] = revision
+        return revision
+
+    def remove(self, dimension, chunk_x, chunk_z):
+
+        key = (dimension, chunk_x, chunk_z)
+
+        if self.revisions.pop(key, None) is not None:
+            os.remove(self.path(*key))
@@ -0,0 +1,628 @@
+"""
+NumPy storage for Minecraft chunk data, used by the map server (mapnode.py)
+
+Each 16x16x16 chunk section keeps its blocks as one contiguous uint16 array
+(blockid << 4 | metadata), the same packing used by the 1.8 protocol, and its
+block light and sky light as one uint8 per block. Arrays are indexed [y, z, x],
+which is the order the section payload is sent in, so a section can be filled
+with a single reshape of the received bytes.
+
+Sections arrive packed: read-only np.frombuffer views straight into the
+received message (ArrayColumn.unpack_payload), which are only decoded into
+arrays the first time they are used (see ArrayChunk).
+"""
+
+import threading
+import zlib
+
+import numpy as np
+
+SECTION_SIZE = 16 * 16 * 16
+SECTION_SHAPE = (16, 16, 16)
+
+BLOCK_BYTES = SECTION_SIZE * 2
+NIBBLE_BYTES = SECTION_SIZE // 2
+BIOME_BYTES = 16 * 16
+
+# blocks that light (and sight) pass through. Not a comprehensive list, but
+# it includes the most common ones
+NONSOLID_BLOCKS = (0, 8, 9, 10, 11, 30, 31, 32, 37, 38, 39, 40, 51, 55, 59, 68,
+                   75, 76, 77, 78, 83, 104, 105, 106, 132, 141, 142, 147, 148,
+                   157, 175)
+
+# is_solid lookup by block ID (block data >> 4)
+SOLID_BLOCKS = np.ones(4096, dtype=bool)
+SOLID_BLOCKS[list(NONSOLID_BLOCKS)] = False
+
+# what a chunk section holds, see MinecraftMap.get_section_occupancy()
+OCCUPANCY_AIR = 0
+OCCUPANCY_OPAQUE = 1
+OCCUPANCY_MIXED = 2
+
+
+def unpack_nibbles(packed):
+    """ Expands an array of packed 4-bit values (low nibble first, as sent by
+    the server) into one uint8 per value, shaped as a chunk section.
+    """
+
+    if not isinstance(packed, np.ndarray):
+        packed = np.frombuffer(packed, dtype=np.uint8)
+
+    packed = packed.ravel()
+    out = np.empty(packed.size * 2, dtype=np.uint8)
+    out[0::2] = packed & 0x0F
+    out[1::2] = packed >> 4
+
+    return out.reshape(SECTION_SHAPE)
+
+
+def pack_nibbles(values):
+    """ Inverse of unpack_nibbles(), returns the packed bytes. """
+
+    values = values.ravel()
+
+    return (values[0::2] & 0x0F | values[1::2] << 4).astype(np.uint8).tobytes()
+
+
+def column_payload_size(mask, skylight=True, continuous=True):
+    """ Returns the number of bytes a column with the given section bitmap
+    takes up in a chunk data or chunk bulk payload.
+    """
+
+    sections = bin(mask & 0xFFFF).count('1')
+    size = sections * (BLOCK_BYTES + NIBBLE_BYTES)
+
+    if skylight:
+        size += sections * NIBBLE_BYTES
+    if continuous:
+        size += BIOME_BYTES
+
+    return size
+
+
+def iter_sections(xs, ys, zs):
+    """ Groups block coordinates by the chunk section they fall in. xs, ys
+    and zs are integer arrays of equal length. Yields (chunk_x, chunk_z,
+    section_y, index) for every section touched, where index is an array of
+    positions into xs/ys/zs. Coordinates outside 0 <= y < 256 are skipped.
+    """
+
+    valid = np.flatnonzero((ys >= 0) & (ys < 256))
+
+    if valid.size == 0:
+        return
+
+    # pack (chunk_x, chunk_z, section_y) into one int64 so np.unique can
+    # group them; chunk coordinates stay well inside +-2**21
+    keys = (((xs[valid] >> 4) + (1 << 21)) << 27 |
+            ((zs[valid] >> 4) + (1 << 21)) << 4 |
+            ys[valid] >> 4)
+    groups, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.searchsorted(inverse[order], np.arange(len(groups) + 1))
+
+    for g in range(len(groups)):
+        key = int(groups[g])
+        chunk_x = (key >> 27) - (1 << 21)
+        chunk_z = ((key >> 4) & ((1 << 23) - 1)) - (1 << 21)
+        index = valid[order[bounds[g]:bounds[g + 1]]]
+        yield chunk_x, chunk_z, key & 0x0F, index
+
+
+def iter_box_sections(x0, y0, z0, x1, y1, z1):
+    """ Splits the box between block coordinates (x0, y0, z0) and (x1, y1, z1)
+    (inclusive, x0 <= x1 etc.) into its intersections with chunk sections.
+    Yields (chunk_x, chunk_z, section_y, src, dst) where src indexes the
+    section's [y, z, x] arrays and dst indexes a [y, z, x] array covering the
+    box. Parts of the box outside 0 <= y < 256 are skipped.
+    """
+
+    for chunk_x in range(x0 >> 4, (x1 >> 4) + 1):
+        ax0 = max(x0, chunk_x * 16)
+        ax1 = min(x1, chunk_x * 16 + 15)
+
+        for chunk_z in range(z0 >> 4, (z1 >> 4) + 1):
+            az0 = max(z0, chunk_z * 16)
+            az1 = min(z1, chunk_z * 16 + 15)
+
+            for section_y in range(max(y0, 0) >> 4, (min(y1, 255) >> 4) + 1):
+                ay0 = max(y0, section_y * 16)
+                ay1 = min(y1, section_y * 16 + 15)
+
+                src = (slice(ay0 - section_y * 16, ay1 - section_y * 16 + 1),
+                       slice(az0 - chunk_z * 16, az1 - chunk_z * 16 + 1),
+                       slice(ax0 - chunk_x * 16, ax1 - chunk_x * 16 + 1))
+                dst = (slice(ay0 - y0, ay1 - y0 + 1),
+                       slice(az0 - z0, az1 - z0 + 1),
+                       slice(ax0 - x0, ax1 - x0 + 1))
+
+                yield chunk_x, chunk_z, section_y, src, dst
+
+
+def section_occupancy(air, solid):
+    """ Returns the OCCUPANCY_* flag of a section holding the given number
+    of air and solid blocks.
+    """
+
+    if air == SECTION_SIZE:
+        return OCCUPANCY_AIR
+    if solid == SECTION_SIZE:
+        return OCCUPANCY_OPAQUE
+    return OCCUPANCY_MIXED
+
+
+def count_occupancy(blocks):
+    """ Returns the number of air and of solid blocks in an array of block
+    data (blockid << 4 | metadata).
+    """
+
+    blockids = blocks >> 4
+
+    return (SECTION_SIZE - int(np.count_nonzero(blockids)),
+            int(np.count_nonzero(SOLID_BLOCKS[blockids])))
+
+
+def exposed_blocks(blocks):
+    """ Returns which blocks of a section can be seen at all: those that are
+    not air and have a face next to a block that is not solid. blocks is the
+    block data of the section with a one block border taken from its
+    neighbours, shaped (18, 18, 18) in y, z, x order. Returns a (16, 16, 16)
+    bool array.
+    """
+
+    blockids = blocks >> 4
+    clear = ~SOLID_BLOCKS[blockids]
+
+    open_face = (clear[:-2, 1:-1, 1:-1] | clear[2:, 1:-1, 1:-1] |
+                 clear[1:-1, :-2, 1:-1] | clear[1:-1, 2:, 1:-1] |
+                 clear[1:-1, 1:-1, :-2] | clear[1:-1, 1:-1, 2:])
+
+    return (blockids[1:-1, 1:-1, 1:-1] != 0) & open_face
+
+
+def column_nbytes(column):
+    """ Returns the approximate number of bytes of chunk data held by a
+    column, either an ArrayColumn or one of spock's smpmap.ChunkColumn.
+    """
+
+    if isinstance(column, ArrayColumn):
+        return column.biome.nbytes + sum(
+            chunk.nbytes() for chunk in column.chunks if chunk is not None)
+
+    # smpmap stores a short per block and a nibble per light value
+    sections = sum(1 for chunk in column.chunks if chunk is not None)
+    return BIOME_BYTES + sections * (BLOCK_BYTES + 2 * NIBBLE_BYTES)
+
+
+class BlockIndex(object):
+    """ Records which chunk sections contain which block types, keyed by
+    section (chunk_x, chunk_z, section_y). Air is not indexed. The positions
+    of a type inside a section are found on demand with a vectorized scan of
+    that one section, so the index stays small while searches only ever look
+    at sections that actually hold the type. Writers and queries that map
+    columns from the chunk cache both update it, under lock.
+    """
+
+    def __init__(self):
+
+        self.lock = threading.RLock()
+
+        # blockid -> {section key: number of blocks of that type}
+        self.sections = {}
+
+        # section key -> {blockid: count}, to undo a section's entries
+        self.counts = {}
+
+    def index_section(self, key, blocks):
+        """ (Re)indexes a section from its uint16 block data array. """
+
+        ids = np.bincount((blocks >> 4).ravel(), minlength=1)
+        present = np.flatnonzero(ids)
+        counts = dict((int(blockid), int(ids[blockid]))
+                      for blockid in present if blockid != 0)
+
+        with self.lock:
+            self.remove_section(key)
+
+            for blockid, count in counts.items():
+                self.sections.setdefault(blockid, {})[key] = count
+
+            self.counts[key] = counts
+
+    def remove_section(self, key):
+
+        with self.lock:
+            for blockid in self.counts.pop(key, {}):
+                by_section = self.sections[blockid]
+                del by_section[key]
+                if not by_section:
+                    del self.sections[blockid]
+
+    def update_block(self, key, old_id, new_id):
+        """ Adjusts the counts of a section after one block changed. """
+
+        if old_id == new_id:
+            return
+
+        with self.lock:
+            counts = self.counts.setdefault(key, {})
+
+            if old_id != 0 and old_id in counts:
+                counts[old_id] -= 1
+                if counts[old_id] == 0:
+                    del counts[old_id]
+                    del self.sections[old_id][key]
+                    if not self.sections[old_id]:
+                        del self.sections[old_id]
+                else:
+                    self.sections[old_id][key] = counts[old_id]
+
+            if new_id != 0:
+                counts[new_id] = counts.get(new_id, 0) + 1
+                self.sections.setdefault(new_id, {})[key] = counts[new_id]
+
+    def sections_with(self, blockids):
+        """ Returns the set of section keys holding any of the given types. """
+
+        keys = set()
+        with self.lock:
+            for blockid in blockids:
+                keys.update(self.sections.get(blockid, ()))
+
+        return keys
+
+
+# forms an ArrayChunk can hold its data in, see ArrayChunk
+DECODED = 0
+RAW = 1
+COMPRESSED = 2
+
+# serializes decode() and pack(), so two threads never decode the same
+# section into different arrays
+_packing_lock = threading.Lock()
+
+
+class ArrayChunk(object):
+    """ One 16x16x16 chunk section. Arrays are indexed [y, z, x].
+
+    A section may be held packed instead, either RAW, as (blocks,
+    light_block, light_sky) views of the protocol payload with the light
+    still in nibbles, or COMPRESSED, as zlib compressed bytes if pack() made
+    it. The arrays are decoded the first time blocks, light_block or
+    light_sky is used.
+
+    All of this lives in the single attribute state, (form, a, b, c), which
+    is only ever replaced as a whole, so threads reading a section never see
+    it half way between two forms.
+    """
+
+    __slots__ = ('state',)
+
+    def __init__(self):
+
+        self.state = (DECODED,
+                      np.zeros(SECTION_SHAPE, dtype=np.uint16),
+                      np.zeros(SECTION_SHAPE, dtype=np.uint8),
+                      np.zeros(SECTION_SHAPE, dtype=np.uint8))
+
+    @classmethod
+    def from_payload(cls, blocks, light_block, light_sky=None):
+        """ Returns a packed section over parts of a protocol payload:
+        blocks is a '<u2' array shaped as a section, the light arrays hold
+        the packed nibbles. light_sky is None if there is no sky light.
+        """
+
+        chunk = cls.__new__(cls)
+        chunk.state = (RAW, blocks, light_block, light_sky)
+
+        return chunk
+
+    @property
+    def packed(self):
+        return self.state[0] != DECODED
+
+    @property
+    def compressed(self):
+        return self.state[0] == COMPRESSED
+
+    @property
+    def blocks(self):
+        return self.decode()[1]
+
+    @blocks.setter
+    def blocks(self, value):
+        state = self.decode()
+        self.state = (DECODED, value, state[2], state[3])
+
+    @property
+    def light_block(self):
+        return self.decode()[2]
+
+    @light_block.setter
+    def light_block(self, value):
+        state = self.decode()
+        self.state = (DECODED, state[1], value, state[3])
+
+    @property
+    def light_sky(self):
+        return self.decode()[3]
+
+    @light_sky.setter
+    def light_sky(self, value):
+        state = self.decode()
+        self.state = (DECODED, state[1], state[2], value)
+
+    @staticmethod
+    def payload(state):
+        """ Returns the (blocks, light_block, light_sky) views of a packed
+        state, decompressing it if needed.
+        """
+
+        if state[0] == RAW:
+            return state[1:]
+
+        data = zlib.decompress(state[1])
+        blocks = np.frombuffer(data, dtype='<u2', count=SECTION_SIZE)
+        light = np.frombuffer(data, dtype=np.uint8, offset=BLOCK_BYTES)
+
+        return (blocks.reshape(SECTION_SHAPE), light[:NIBBLE_BYTES],
+                light[NIBBLE_BYTES:])
+
+    def arrays(self):
+        """ Returns (blocks, light_block, light_sky) without keeping them
+        decoded, for one-off reads of the whole section. The arrays are new
+        ones if the section is packed.
+        """
+
+        state = self.state
+        if state[0] == DECODED:
+            return state[1:]
+
+        blocks, light_block, light_sky = self.payload(state)
+
+        if light_sky is None:
+            light_sky = np.zeros(SECTION_SHAPE, dtype=np.uint8)
+        else:
+            light_sky = unpack_nibbles(light_sky)
+
+        return (blocks.astype(np.uint16), unpack_nibbles(light_block),
+                light_sky)
+
+    def view_blocks(self):
+        """ Returns the block data, read-only and without decoding the
+        section if it is packed.
+        """
+
+        state = self.state
+        if state[0] == DECODED:
+            return state[1]
+
+        return self.payload(state)[0]
+
+    def decode(self):
+        """ Decodes the section if needed and returns its decoded state. """
+
+        state = self.state
+        if state[0] == DECODED:
+            return state
+
+        with _packing_lock:
+            if self.state[0] != DECODED:
+                self.state = (DECODED,) + tuple(self.arrays())
+            return self.state
+
+    def pack(self):
+        """ Drops the arrays, keeping the section as compressed bytes. """
+
+        with _packing_lock:
+            state = self.state
+            if state[0] != DECODED:
+                return
+
+            data = b''.join((state[1].astype('<u2').tobytes(),
+                             pack_nibbles(state[2]), pack_nibbles(state[3])))
+            self.state = (COMPRESSED, zlib.compress(data, 1), None, None)
+
+    def copy(self):
+        """ Returns a decoded copy that shares no arrays with this one. """
+
+        chunk = ArrayChunk.__new__(ArrayChunk)
+        state = self.state
+
+        if state[0] == DECODED:
+            chunk.state = (DECODED,) + tuple(a.copy() for a in state[1:])
+        else:
+            chunk.state = (DECODED,) + tuple(self.arrays())
+
+        return chunk
+
+    def nbytes(self):
+
+        state = self.state
+        if state[0] == COMPRESSED:
+            return len(state[1])
+
+        return sum(part.nbytes for part in state[1:] if part is not None)
+
+
+class ArrayColumn(object):
+    """ A column of 16 ArrayChunk sections plus its 16x16 biome map (indexed
+    [z, x]). Has the same unpack() signature as spock's smpmap.ChunkColumn so
+    the two can be swapped in MinecraftMap.
+
+    The column also keeps its surface: heightmap holds the y of the topmost
+    solid block of each (x, z) (-1 if there is none) and topblock its block
+    data, both indexed [z, x]. They are rebuilt by update_surface() and kept
+    current for single blocks by update_surface_at().
+    """
+
+    __slots__ = ('chunks', 'biome', 'heightmap', 'topblock')
+
+    def __init__(self):
+
+        self.chunks = [None] * 16
+        self.biome = np.zeros((16, 16), dtype=np.uint8)
+        self.heightmap = np.full((16, 16), -1, dtype=np.int16)
+        self.topblock = np.zeros((16, 16), dtype=np.uint16)
+
+    def copy(self):
+        """ Returns a copy that can be changed without touching this column.
+        The sections themselves are shared.
+        """
+
+        column = ArrayColumn.__new__(ArrayColumn)
+        column.chunks = list(self.chunks)
+        column.biome = self.biome.copy()
+        column.heightmap = self.heightmap.copy()
+        column.topblock = self.topblock.copy()
+
+        return column
+
+    def update_surface(self):
+        """ Recomputes the heightmap and top blocks of the whole column. """
+
+        heightmap = np.full((16, 16), -1, dtype=np.int16)
+        topblock = np.zeros((16, 16), dtype=np.uint16)
+        z, x = np.indices((16, 16))
+
+        for section_y in range(15, -1, -1):
+            chunk = self.chunks[section_y]
+            if chunk is None:
+                continue
+
+            open_columns = heightmap < 0
+            if not open_columns.any():
+                break
+
+            blocks = chunk.view_blocks()
+            solid = SOLID_BLOCKS[blocks >> 4]
+            has_solid = solid.any(axis=0) & open_columns
+            top = 15 - np.argmax(solid[::-1], axis=0)
+
+            heightmap[has_solid] = section_y * 16 + top[has_solid]
+            topblock[has_solid] = blocks[top, z, x][has_solid]
+
+        self.heightmap = heightmap
+        self.topblock = topblock
+
+    def update_surface_at(self, rx, y, rz):
+        """ Updates the surface of one (x, z) after the block at height y
+        changed.
+        """
+
+        section_y, ry = divmod(y, 16)
+        block = int(self.chunks[section_y].view_blocks()[ry, rz, rx])
+        height = self.heightmap[rz, rx]
+
+        if SOLID_BLOCKS[block >> 4]:
+            if y >= height:
+                self.heightmap[rz, rx] = y
+                self.topblock[rz, rx] = block
+            return
+
+        if y != height:
+            return
+
+        # the top block was removed, look further down
+        self.heightmap[rz, rx] = -1
+        self.topblock[rz, rx] = 0
+
+        for section_y in range(section_y, -1, -1):
+            chunk = self.chunks[section_y]
+            if chunk is None:
+                continue
+
+            blocks = chunk.view_blocks()[:, rz, rx]
+            solid = np.flatnonzero(SOLID_BLOCKS[blocks >> 4])
+            if solid.size:
+                self.heightmap[rz, rx] = section_y * 16 + solid[-1]
+                self.topblock[rz, rx] = blocks[solid[-1]]
+                return
+
+    def unpack(self, buff, mask, skylight=True, continuous=True):
+
+        self.unpack_payload(
+            buff.read(column_payload_size(mask, skylight, continuous)),
+            mask, skylight, continuous)
+
+    def pack_payload(self, skylight=True, continuous=True):
+        """ Inverse of unpack_payload(): returns (mask, data), the section
+        bitmap and protocol payload of this column.
+        """
+
+        mask = 0
+        blocks = []
+        light_block = []
+        light_sky = []
+
+        for i, chunk in enumerate(self.chunks):
+            if chunk is None:
+                continue
+
+            mask |= 1 << i
+            arrays = chunk.arrays()
+            blocks.append(arrays[0].astype('<u2').tobytes())
+            light_block.append(pack_nibbles(arrays[1]))
+            light_sky.append(pack_nibbles(arrays[2]))
+
+        parts = blocks + light_block
+        if skylight:
+            parts += light_sky
+        if continuous:
+            parts.append(self.biome.astype(np.uint8).tobytes())
+
+        return mask, b''.join(parts)
+
+    def unpack_payload(self, data, mask, skylight=True, continuous=True,
+                       offset=0):
+        """ Reads the sections in mask from a chunk payload (bytes), starting
+        at offset, and returns the offset just past them. Sections keep
+        views into the column's payload and are decoded on first use. If
+        data holds more than this column (a chunk bulk), the column's part
+        is copied once, so the sections do not keep the whole message alive
+        and column_nbytes() stays right.
+        """
+
+        # as in the protocol, all block data comes first, then all block
+        # light, then all sky light; sections are not grouped together
+        chunk_idx = [i for i in range(16) if mask & (1 << i)]
+        n = len(chunk_idx)
+
+        end = offset + column_payload_size(mask, skylight, continuous)
+        if offset or end < len(data):
+            data = data[offset:end]
+            start, offset = offset, 0
+        else:
+            start = 0
+
+        if n:
+            blocks = np.frombuffer(data, dtype='<u2', count=n * SECTION_SIZE,
+                                   offset=offset).reshape((n,) + SECTION_SHAPE)
+            offset += n * BLOCK_BYTES
+
+            light_block = np.frombuffer(
+                data, dtype=np.uint8, count=n * NIBBLE_BYTES,
+                offset=offset).reshape(n, NIBBLE_BYTES)
+            offset += n * NIBBLE_BYTES
+
+            if skylight:
+                light_sky = np.frombuffer(
+                    data, dtype=np.uint8, count=n * NIBBLE_BYTES,
+                    offset=offset).reshape(n, NIBBLE_BYTES)
+                offset += n * NIBBLE_BYTES
+            else:
+                light_sky = [None] * n
+
+            for k, i in enumerate(chunk_idx):
+                self.chunks[i] = ArrayChunk.from_payload(
+                    blocks[k], light_block[k], light_sky[k])
+
+        if continuous:
+            self.biome = np.frombuffer(
+                data, dtype=np.uint8, count=BIOME_BYTES,
+                offset=offset).reshape(16, 16).copy()
+            offset += BIOME_BYTES
+
+        return start + offset
@@ -0,0 +1,232 @@
+"""
+Reads Minecraft 1.8 Anvil saves (level.dat and region/r.X.Z.mca files) into
+the map server's storage, without a running Minecraft server
+
+The saves shipped in world/ can be used to warm up a MinecraftMap for tests
+and benchmarks, e.g.
+
+    loader = RegionLoader('world/terrainworld')
+    spawn_x, spawn_y, spawn_z = loader.get_spawn()
+    loader.preload(world, spawn_x, spawn_z, radius=4)
+"""
+
+import gzip
+import os
+import zlib
+
+import numpy as np
+
+from spockbot.mcp import nbt
+from spockbot.mcp.bbuff import BoundBuffer, BufferUnderflowException
+
+from mc_map_utils import ArrayChunk, ArrayColumn, SECTION_SHAPE, \
+    unpack_nibbles
+
+SECTOR_BYTES = 4096
+
+COMPRESSION_GZIP = 1
+COMPRESSION_ZLIB = 2
+
+
+def read_nbt(data):
+    """ Parses an uncompressed NBT document and returns its root compound. """
+
+    bbuff = BoundBuffer(data)
+
+    if nbt.TagByte(buffer=bbuff).value != nbt.TAG_COMPOUND:
+        raise nbt.MalformedFileError("root tag is not a compound")
+
+    name = nbt.TagString(buffer=bbuff).value
+    root = nbt.TagCompound(buffer=bbuff)
+    root.name = name
+
+    return root
+
+
+def section_from_nbt(section):
+    """ Builds an ArrayChunk from one entry of a chunk's 'Sections' list.
+    Anvil sections store block ids, metadata and light in the same y-z-x
+    order as the network protocol.
+    """
+
+    chunk = ArrayChunk()
+
+    ids = np.frombuffer(
+        bytes(section['Blocks'].value), dtype=np.uint8).astype(np.uint16)
+    ids = ids.reshape(SECTION_SHAPE)
+
+    if 'Add' in section:
+        ids |= unpack_nibbles(bytes(section['Add'].value)).astype(
+            np.uint16) << 8
+
+    meta = unpack_nibbles(bytes(section['Data'].value))
+    chunk.blocks = ids << 4 | meta
+
+    chunk.light_block = unpack_nibbles(bytes(section['BlockLight'].value))
+    if 'SkyLight' in section:
+        chunk.light_sky = unpack_nibbles(bytes(section['SkyLight'].value))
+
+    return chunk
+
+
+def column_from_nbt(root):
+    """ Builds an ArrayColumn from the root compound of a stored chunk.
+    Returns (chunk_x, chunk_z, column).
+    """
+
+    level = root['Level']
+    column = ArrayColumn()
+
+    for section in level['Sections']:
+        y = section['Y'].value
+        if 0 <= y <= 0x0F:
+            column.chunks[y] = section_from_nbt(section)
+
+    if 'Biomes' in level and len(level['Biomes'].value) == 256:
+        biome = np.frombuffer(bytes(level['Biomes'].value), dtype=np.uint8)
+        column.biome = biome.reshape(16, 16).copy()
+
+    return level['xPos'].value, level['zPos'].value, column
+
+
+class RegionFile(object):
+    """ One r.X.Z.mca file, holding up to 32x32 chunk columns. """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path, 'rb') as region:
+            header = region.read(SECTOR_BYTES)
+
+        if len(header) < SECTOR_BYTES:
+            # empty or truncated region, treat it as holding no chunks
+            header = b'\x00' * SECTOR_BYTES
+
+        self.locations = np.frombuffer(header, dtype='>u4')
+
+    def has_chunk(self, chunk_x, chunk_z):
+
+        return self.locations[(chunk_x & 31) + (chunk_z & 31) * 32] != 0
+
+    def read_chunk(self, chunk_x, chunk_z):
+        """ Returns the root NBT compound of the chunk, or None if the chunk
+        has not been generated.
+        """
+
+        location = int(self.locations[(chunk_x & 31) + (chunk_z & 31) * 32])
+
+        if location == 0:
+            return None
+
+        offset = (location >> 8) * SECTOR_BYTES
+        sectors = location & 0xFF
+
+        with open(self.path, 'rb') as region:
+            region.seek(offset)
+            data = region.read(sectors * SECTOR_BYTES)
+
+        length = int(np.frombuffer(data[:4], dtype='>u4')[0])
+        compression = ord(data[4:5])
+        payload = data[5:4 + length]
+
+        if compression == COMPRESSION_ZLIB:
+            payload = zlib.decompress(payload)
+        elif compression == COMPRESSION_GZIP:
+            payload = zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+        else:
+            raise nbt.MalformedFileError("unknown chunk compression %d in %s"
+                                         % (compression, self.path))
+
+        return read_nbt(payload)
+
+
+class RegionLoader(object):
+    """ Loads chunk columns from a world save directory (the one containing
+    level.dat and region/).
+    """
+
+    def __init__(self, world_dir):
+
+        self.world_dir = world_dir
+        self.regions = {}
+
+        # (chunk_x, chunk_z) of stored chunks that could not be decoded
+        self.damaged = []
+
+    def read_level(self):
+        """ Returns the 'Data' compound of level.dat. """
+
+        with gzip.open(os.path.join(self.world_dir, 'level.dat'), 'rb') as f:
+            return read_nbt(f.read())['Data']
+
+    def get_spawn(self):
+        """ Returns the world spawn point (x, y, z) from level.dat. """
+
+        data = self.read_level()
+
+        return data['SpawnX'].value, data['SpawnY'].value, data['SpawnZ'].value
+
+    def get_region(self, region_x, region_z):
+
+        key = (region_x, region_z)
+
+        if key not in self.regions:
+            path = os.path.join(
+                self.world_dir, 'region', 'r.%d.%d.mca' % key)
+            self.regions[key] = RegionFile(path) if os.path.isfile(
+                path) else None
+
+        return self.regions[key]
+
+    def load_column(self, chunk_x, chunk_z):
+        """ Returns the ArrayColumn at the given chunk coordinates, or None if
+        it is not in the save.
+        """
+
+        region = self.get_region(chunk_x >> 5, chunk_z >> 5)
+
+        if region is None:
+            return None
+
+        root = region.read_chunk(chunk_x, chunk_z)
+
+        if root is None:
+            return None
+
+        return column_from_nbt(root)[2]
+
+    def preload(self, world, x, z, radius):
+        """ Loads every stored column within radius chunks of block
+        coordinates (x, z) into world.columns, replacing what is there.
+        Columns that cannot be decoded are skipped and recorded in
+        self.damaged. Returns the number of columns loaded.
+        """
+
+        if world.column_type is not ArrayColumn:
+            raise ValueError("region loading needs the numpy map storage")
+
+        center_x = int(x) >> 4
+        center_z = int(z) >> 4
+        loaded = 0
+
+        with world.write_lock:
+            for chunk_x in range(center_x - radius, center_x + radius + 1):
+                for chunk_z in range(center_z - radius,
+                                     center_z + radius + 1):
+                    try:
+                        column = self.load_column(chunk_x, chunk_z)
+                    except (zlib.error, nbt.MalformedFileError, ValueError,
+                            KeyError, BufferUnderflowException):
+                        self.damaged.append((chunk_x, chunk_z))
+                        continue
+
+                    if column is not None:
+                        world.columns[(chunk_x, chunk_z)] = column
+                        world.account_column((chunk_x, chunk_z))
+                        loaded += 1
+
+            world.enforce_budget()
+            world.commit()
+
+        return loaded
@@ -12,10 +12,15 @@ import rospy
 
 from minecraft_bot.srv import get_block_multi_srv
 from minecraft_bot.msg import map_block_msg, vec3_msg
+from mc_map_utils import NONSOLID_BLOCKS, SOLID_BLOCKS, OCCUPANCY_AIR, \
+    OCCUPANCY_OPAQUE
+
+from collections import deque, OrderedDict
 
 import math
 import numpy as np
 from sys import argv
+import threading
 import time
 
 # radius of vision
@@ -30,8 +35,26 @@ D_YAW = 15.
 R_PITCH = 60
 R_YAW = 60
 
+# level of detail: rays start D_PITCH apart and are split in two whenever
+# neighbours drift a block apart, but never spread finer than LOD_MIN_STEP
+# degrees. With it the view reaches LOD_MAX_DIST blocks
+LOD_MIN_STEP = 1.5
+LOD_MAX_DIST = 32
+
+# ways of finding the blocks along each ray. 'sample' looks at points D_DIST
+# apart, 'dda' visits every block a ray passes through
+MODE_SAMPLE = 'sample'
+MODE_DDA = 'dda'
+
 block_mats = {}
 
+# (d_pitch, d_yaw) -> cosines and sines of the ray offsets, see
+# direction_table()
+direction_tables = {}
+
+# distances of the points sampled along each ray
+SAMPLE_DISTANCES = D_DIST * np.arange(int(MAX_DIST / D_DIST) + 1)
+
 
 def init_block_mats():
     """ Sets up a bitmap (called block_mats) of possible block material types
@@ -39,41 +62,8 @@ def init_block_mats():
     (True) or nonsolid (False).
     """
 
-    # this is not a comprehensive list, but includes most common solid blocks
-    # probably a better way to do this
     blocks = [i for i in range(256)]
-    nonsolids = [
-        0,
-        8,
-        9,
-        10,
-        11,
-        30,
-        31,
-        32,
-        37,
-        38,
-        39,
-        40,
-        51,
-        55,
-        59,
-        68,
-        75,
-        76,
-        77,
-        78,
-        83,
-        104,
-        105,
-        106,
-        132,
-        141,
-        142,
-        147,
-        148,
-        157,
-        175]
+    nonsolids = NONSOLID_BLOCKS
 
     for blockid in blocks:
         block_mats[blockid] = True
@@ -155,16 +145,10 @@ def get_coordinates_in_range(x, y, z, pitch, yaw):
         all_coords: List of all possible blocks visible by the bot.
     """
 
-    pit_range = np.arange(pitch - R_PITCH, pitch + R_PITCH + D_PITCH, D_PITCH)
-    yaw_range = np.arange(yaw - R_YAW, yaw + R_YAW + D_YAW, D_YAW)
-    num_steps = np.arange(0, int(MAX_DIST / D_DIST) + D_DIST)
+    coords = get_sample_coordinates(x, y, z, pitch, yaw)
 
     # ROS messages only support 1-D arrays...
-    ray_steps = [calc_ray_step(pt, yw, D_DIST)
-                 for pt in pit_range for yw in yaw_range]
-
-    all_coords = [create_vec3_msg((x, y, z), step, num)
-                  for step in ray_steps for num in num_steps]
+    all_coords = [vec3_msg(x=cx, y=cy, z=cz) for cx, cy, cz in coords.tolist()]
     return all_coords
 
 
@@ -225,3 +209,806 @@ def get_visible_blocks(blocks):
     # print "total: %f"%(end-start)
 
     return vis_blocks_list
+
+
+def direction_table(d_pitch, d_yaw):
+    """
+    Returns the cosines and sines of the pitch and yaw offsets of the rays
+    from the view direction, as four arrays with one entry per ray (ordered
+    by pitch, then yaw). Tables are computed once per angular grid.
+    """
+
+    key = (d_pitch, d_yaw)
+    table = direction_tables.get(key)
+
+    if table is None:
+        pit_offsets = -R_PITCH + d_pitch * np.arange(
+            int(2 * R_PITCH / d_pitch) + 1)
+        yaw_offsets = -R_YAW + d_yaw * np.arange(int(2 * R_YAW / d_yaw) + 1)
+
+        rad_pitch = np.radians(np.repeat(pit_offsets, len(yaw_offsets)))
+        rad_yaw = np.radians(np.tile(yaw_offsets, len(pit_offsets)))
+
+        table = (np.cos(rad_pitch), np.sin(rad_pitch),
+                 np.cos(rad_yaw), np.sin(rad_yaw))
+        direction_tables[key] = table
+
+    return table
+
+
+def ray_directions(pitch, yaw, d_pitch=D_PITCH, d_yaw=D_YAW):
+    """
+    Returns the unit vectors of the rays covering pitch +- R_PITCH and
+    yaw +- R_YAW, d_pitch and d_yaw degrees apart, as an (n, 3) array in
+    the same (dx, dy, dz) convention as calc_ray_step. Rays are ordered by
+    pitch, then yaw.
+    """
+
+    cos_dpitch, sin_dpitch, cos_dyaw, sin_dyaw = direction_table(
+        d_pitch, d_yaw)
+
+    rad_pitch = math.radians(pitch)
+    rad_yaw = math.radians(yaw)
+    cospitch, sinpitch = math.cos(rad_pitch), math.sin(rad_pitch)
+    cosyaw, sinyaw = math.cos(rad_yaw), math.sin(rad_yaw)
+
+    # turn the table by the view direction, e.g.
+    # sin(pitch + dpitch) = sin(pitch) cos(dpitch) + cos(pitch) sin(dpitch)
+    abs_cospitch = np.abs(cospitch * cos_dpitch - sinpitch * sin_dpitch)
+    sinpitch = sinpitch * cos_dpitch + cospitch * sin_dpitch
+    cosyaw, sinyaw = (cosyaw * cos_dyaw - sinyaw * sin_dyaw,
+                      sinyaw * cos_dyaw + cosyaw * sin_dyaw)
+
+    return np.column_stack((-abs_cospitch * sinyaw, -sinpitch,
+                            abs_cospitch * cosyaw))
+
+
+def get_sample_coordinates(x, y, z, pitch, yaw):
+    """
+    Returns the blocks get_coordinates_in_range samples, as an (n, 3) int64
+    array of (x, y, z) in the same order.
+    """
+
+    origin = np.array((x, y, z), dtype=np.float64)
+    offsets = (ray_directions(pitch, yaw)[:, np.newaxis, :] *
+               SAMPLE_DISTANCES[:, np.newaxis])
+
+    return np.floor(origin + offsets).astype(np.int64).reshape(-1, 3)
+
+
+def traverse_rays(origin, directions, max_dist=MAX_DIST, entry=False):
+    """
+    Walks all rays from origin through the block grid at once (Amanatides
+    and Woo's voxel traversal). Every block a ray passes through within
+    max_dist is visited exactly once, in order.
+
+    Args:
+        origin: (x, y, z) start of the rays, in block coordinates, or an
+            (n, 3) array with the start of each ray.
+        directions: (n, 3) array of unit ray directions.
+        max_dist: Length of the rays in blocks, or an array of n lengths.
+        entry: Also return where each ray enters each block.
+
+    Returns:
+        (path, valid): path is an (n, steps, 3) int64 array of the blocks
+        along each ray, valid an (n, steps) bool array that is False once a
+        ray has left its range. With entry, (path, valid, distance), where
+        distance is an (n, steps) array of the distances at which the ray
+        enters each block.
+    """
+
+    directions = np.asarray(directions, dtype=np.float64)
+    origin = np.asarray(origin, dtype=np.float64) + np.zeros_like(directions)
+    max_dist = np.asarray(max_dist, dtype=np.float64)
+    rays = np.arange(len(directions))
+
+    # a segment of length L crosses at most L * |d| + 1 block boundaries
+    # along each axis
+    num_steps = 4 + int(
+        (max_dist * np.abs(directions).sum(axis=1)).max())
+
+    voxel = np.floor(origin).astype(np.int64)
+    step = np.sign(directions).astype(np.int64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_delta = np.abs(1. / directions)
+        t_max = np.where(step > 0, voxel + 1 - origin,
+                         np.where(step < 0, voxel - origin, np.inf))
+        t_max = np.where(step != 0, t_max / directions, np.inf)
+
+    path = np.empty((len(directions), num_steps, 3), dtype=np.int64)
+    valid = np.zeros((len(directions), num_steps), dtype=bool)
+
+    distance = np.zeros((len(directions), num_steps))
+
+    path[:, 0] = voxel
+    valid[:, 0] = True
+    alive = valid[:, 0].copy()
+
+    for i in range(1, num_steps):
+        axis = t_max.argmin(axis=1)
+        distance[:, i] = t_max[rays, axis]
+        alive &= distance[:, i] <= max_dist
+
+        voxel[rays, axis] += step[rays, axis]
+        t_max[rays, axis] += t_delta[rays, axis]
+
+        path[:, i] = voxel
+        valid[:, i] = alive
+
+    if entry:
+        return path, valid, distance
+
+    return path, valid
+
+
+def lod_bands(angle_step, max_dist, min_step=LOD_MIN_STEP):
+    """
+    Splits the view range into distance bands for level of detail casting.
+    The rays of each band are half as far apart as those of the band before,
+    and a band ends where its neighbouring rays are about a block apart.
+    Splitting stops at min_step degrees; the last band reaches max_dist.
+
+    Returns:
+        A list of (angle_step, start, end) per band, distances in blocks.
+    """
+
+    bands = []
+    start = 0.
+
+    while True:
+        end = 1. / math.radians(angle_step)
+
+        if end >= max_dist or angle_step / 2. < min_step:
+            bands.append((angle_step, start, float(max_dist)))
+            return bands
+
+        bands.append((angle_step, start, end))
+        start = end
+        angle_step /= 2.
+
+
+def ray_layout(x, y, z, pitch, yaw, bands):
+    """
+    Lays out the rays of a field of view split into distance bands (see
+    lod_bands). The rays of a band run from its start to its end, those of
+    band k + 1 are children of the (up to four) nearest rays of band k.
+
+    Returns:
+        (origins, directions, lengths, band_slices, parents): the start,
+        unit direction and length of every ray, band by band, as arrays for
+        traverse_rays; the slice of the rays of each band; and an (n, 4)
+        array of the indices of each ray's parents (-1 in the first band).
+    """
+
+    origin = np.array((x, y, z), dtype=np.float64)
+    directions = []
+    starts = []
+    lengths = []
+    band_slices = []
+    parents = []
+
+    first = 0
+    prev_pitches = prev_yaws = 0
+
+    for angle_step, start, end in bands:
+        rays = ray_directions(pitch, yaw, angle_step, angle_step)
+        num_pitches = int(2 * R_PITCH / angle_step) + 1
+        num_yaws = int(2 * R_YAW / angle_step) + 1
+
+        if band_slices:
+            # rays between two parents have both of them, per axis
+            prev_first = band_slices[-1].start
+            j_pitch = np.repeat(np.arange(num_pitches), num_yaws)
+            j_yaw = np.tile(np.arange(num_yaws), num_pitches)
+
+            pitches = [np.minimum(j_pitch // 2, prev_pitches - 1),
+                       np.minimum((j_pitch + 1) // 2, prev_pitches - 1)]
+            yaws = [np.minimum(j_yaw // 2, prev_yaws - 1),
+                    np.minimum((j_yaw + 1) // 2, prev_yaws - 1)]
+
+            parents.append(np.column_stack(
+                [prev_first + p * prev_yaws + q
+                 for p in pitches for q in yaws]))
+        else:
+            parents.append(np.full((len(rays), 4), -1, dtype=np.int64))
+
+        directions.append(rays)
+        starts.append(np.full(len(rays), start))
+        lengths.append(np.full(len(rays), end - start))
+        band_slices.append(slice(first, first + len(rays)))
+
+        first += len(rays)
+        prev_pitches, prev_yaws = num_pitches, num_yaws
+
+    directions = np.concatenate(directions)
+    origins = origin + directions * np.concatenate(starts)[:, np.newaxis]
+
+    return (origins, directions, np.concatenate(lengths), band_slices,
+            np.concatenate(parents))
+
+
+def pack_voxels(voxels):
+    """ Packs block coordinates (an array of shape (..., 3)) into one int64
+    each, for sorting and set operations. x and z must lie within +-2**25,
+    y within +-1024.
+    """
+
+    voxels = np.asarray(voxels, dtype=np.int64)
+
+    return (((voxels[..., 0] + (1 << 25)) << 37) |
+            ((voxels[..., 2] + (1 << 25)) << 11) |
+            (voxels[..., 1] + 1024))
+
+
+def contains(sorted_keys, keys):
+    """ Returns a bool array telling which of keys are in the sorted array
+    sorted_keys.
+    """
+
+    if len(sorted_keys) == 0:
+        return np.zeros(np.shape(keys), dtype=bool)
+
+    pos = np.searchsorted(sorted_keys, keys)
+    return sorted_keys[np.minimum(pos, len(sorted_keys) - 1)] == keys
+
+
+def visible_mask(ray_ids, inside):
+    """
+    Follows every ray up to and including its first solid block.
+
+    Args:
+        ray_ids: (rays, steps) array of the block IDs along each ray.
+        inside: (rays, steps) bool array, False past the end of a ray.
+
+    Returns:
+        (rays, steps) bool array marking the blocks that are not air and
+        can be seen.
+    """
+
+    ray_ids = np.where(inside, ray_ids, 0)
+    solid = SOLID_BLOCKS[ray_ids] & inside
+
+    # rays that hit nothing solid are followed to their end
+    last = np.where(solid.any(axis=1), solid.argmax(axis=1),
+                    ray_ids.shape[1])
+
+    return (inside & (ray_ids != 0) &
+            (np.arange(ray_ids.shape[1]) <= last[:, np.newaxis]))
+
+
+def make_block_msgs(voxels, blockids, metas):
+    """ Builds map_block_msgs from an (n, 3) array of block coordinates and
+    their block IDs and metadata.
+    """
+
+    return [map_block_msg(blockid=blockid, metadata=meta, x=x, y=y, z=z)
+            for (x, y, z), blockid, meta
+            in zip(np.asarray(voxels).tolist(), np.asarray(blockids).tolist(),
+                   np.asarray(metas).tolist())]
+
+
+def block_arrays(blocks):
+    """ The reverse of make_block_msgs: returns (voxels, blockids, metas)
+    of a list of map_block_msgs.
+    """
+
+    voxels = np.array([(block.x, block.y, block.z) for block in blocks],
+                      dtype=np.int64).reshape(-1, 3)
+    blockids = np.array([block.blockid for block in blocks], dtype=np.uint16)
+    metas = np.array([block.metadata for block in blocks], dtype=np.uint16)
+
+    return voxels, blockids, metas
+
+
+def diff_visible(old, new):
+    """ Compares two visible sets, each (voxels, blockids, metas) as
+    returned by VisibilityEngine.get_visible. Returns (changed, removed):
+    the indices of the blocks of new that are not in old or differ from it
+    there, and an (n, 3) array of the blocks of old that are not in new.
+    """
+
+    old_keys = pack_voxels(np.reshape(old[0], (-1, 3)))
+    new_keys = pack_voxels(np.reshape(new[0], (-1, 3)))
+
+    order = np.argsort(old_keys)
+    old_keys = old_keys[order]
+    old_data = (np.asarray(old[1], dtype=np.int64) << 4 |
+                np.asarray(old[2], dtype=np.int64))[order]
+    new_data = (np.asarray(new[1], dtype=np.int64) << 4 |
+                np.asarray(new[2], dtype=np.int64))
+
+    found = contains(old_keys, new_keys)
+    pos = np.searchsorted(old_keys, new_keys[found])
+    same = np.zeros(len(new_keys), dtype=bool)
+    same[found] = old_data[pos] == new_data[found]
+
+    gone = ~contains(np.sort(new_keys), old_keys)
+
+    return (np.flatnonzero(~same),
+            np.reshape(old[0], (-1, 3))[order[gone]])
+
+
+class VisibilityEngine(object):
+    """ Finds the blocks the bot can see, by casting the rays of its field
+    of view (see ray_layout) against a map.
+
+    get_blocks(xs, ys, zs) looks up many blocks at once and returns their
+    block IDs and metadata as two arrays, like MinecraftMap.get_blocks. Run
+    inside the map server it reads the map directly, so only the visible
+    blocks have to be sent to other nodes.
+
+    Visibility is computed incrementally: the blocks along every ray of the
+    last frame are kept, and a ray is only cast again if its path through
+    the block grid changed with the pose, or if it crosses blocks reported
+    by mark_changed().
+
+    With lod, rays are split with distance (see lod_bands), and the rays
+    of a band are only cast if one of their parents saw nothing solid.
+
+    get_occupancy(sections), if given, returns the OCCUPANCY_* flags of an
+    (n, 3) array of (chunk_x, chunk_z, section_y), like
+    MinecraftMap.get_section_occupancy. Blocks in sections that are all
+    air are then not looked up, and rays stop at the first block of a
+    section that is all solid.
+
+    get_exposed(xs, ys, zs), if given, tells which blocks are not air and
+    next to a block that is not solid, like MinecraftMap.get_exposed. Only
+    those blocks, and the first block of every ray, are looked up: a ray
+    can only reach any other block through a solid one, where it ends.
+
+    With cache_size > 0, poses are rounded to cache_position_step blocks and
+    cache_angle_step degrees, and the results of the last cache_size rounded
+    poses are kept. A result is reused as long as the revisions of the
+    sections its rays cross are unchanged; get_revision(chunk_x, chunk_z,
+    section_y) returns them (see MinecraftMap.get_revision).
+    """
+
+    def __init__(self, get_blocks, angle_step=D_PITCH, max_dist=MAX_DIST,
+                 get_revision=None, cache_size=0, cache_position_step=0.25,
+                 cache_angle_step=1., lod=False, lod_min_step=LOD_MIN_STEP,
+                 get_occupancy=None, get_exposed=None):
+
+        self.get_blocks = get_blocks
+        self.get_occupancy = get_occupancy
+        self.get_exposed = get_exposed
+        self.angle_step = angle_step
+        self.max_dist = max_dist
+
+        if lod:
+            self.bands = lod_bands(angle_step, max_dist, lod_min_step)
+        else:
+            self.bands = [(angle_step, 0., float(max_dist))]
+
+        # rounded pose -> (sections, revisions, result), least recently used
+        # first. sections is an (n, 3) array of (chunk_x, chunk_z,
+        # section_y), revisions their revisions when result was computed
+        self.get_revision = get_revision
+        self.cache_size = cache_size if get_revision is not None else 0
+        self.cache_position_step = cache_position_step
+        self.cache_angle_step = cache_angle_step
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+
+        # (sections, revisions) of the last cast frame
+        self.frame_revisions = None
+
+        # highest revision handed to mark_changed(). A result is only cached
+        # if every change to its sections has been marked before it was
+        # computed, otherwise it may be older than its revisions
+        self.marked_revision = 0
+
+        # get_visible and mark_changed may be called from several threads.
+        # mark_changed only queues the changes in pending_changes, so the
+        # map's publisher never waits for a cast; get_visible drains them
+        # under lock before it reads any revision
+        self.lock = threading.Lock()
+        self.pending_changes = deque()
+
+        # the last frame: its pose and result, packed blocks along every ray
+        # (pack_voxels), where each ray ends, the block IDs and metadata
+        # found along it, and which rays were cast (with lod, rays behind
+        # solid blocks are not)
+        self.pose = None
+        self.visible = None
+        self.ray_keys = None
+        self.ray_inside = None
+        self.ray_ids = None
+        self.ray_metas = None
+        self.ray_known = None
+
+        # map changes since the last frame, as packed blocks and packed
+        # sections (a section's key is pack_voxels of its chunk_x,
+        # section_y, chunk_z)
+        self.changed_blocks = set()
+        self.changed_sections = set()
+
+        self.frames = 0
+        self.rays_cast = 0
+        self.rays_reused = 0
+        self.blocks_looked_up = 0
+        self.steps_skipped = 0
+        self.rays_skipped = 0
+        self.blocks_buried = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+
+    def mark_changed(self, changes):
+        """ Records map changes, in the format MinecraftMap.publish_changes
+        hands them out: a list of ((chunk_x, chunk_z, section_y), revision,
+        blocks), where blocks is a list of (x, y, z, data) or None if the
+        whole section changed.
+        """
+
+        for (chunk_x, chunk_z, section_y), revision, blocks in changes:
+            if blocks is None:
+                self.pending_changes.append((revision, int(
+                    pack_voxels((chunk_x, section_y, chunk_z))), None))
+            else:
+                self.pending_changes.append((revision, None, pack_voxels(
+                    [block[:3] for block in blocks]).tolist()))
+
+    def drain_changes(self):
+        """ Moves the changes queued by mark_changed() into changed_blocks
+        and changed_sections. Called under lock.
+        """
+
+        while self.pending_changes:
+            revision, section, blocks = self.pending_changes.popleft()
+            self.marked_revision = max(self.marked_revision, revision)
+            if blocks is None:
+                self.changed_sections.add(section)
+            else:
+                self.changed_blocks.update(blocks)
+
+    def touches_changes(self, ray_keys, ray_path, inside):
+        """ Returns which rays cross a block or section in the changes
+        recorded since the last frame.
+        """
+
+        hit = np.zeros(len(ray_keys), dtype=bool)
+
+        if self.changed_blocks:
+            changed = np.array(sorted(self.changed_blocks), dtype=np.int64)
+            hit |= (contains(changed, ray_keys) & inside).any(axis=1)
+
+        if self.changed_sections:
+            changed = np.array(sorted(self.changed_sections), dtype=np.int64)
+            sections = pack_voxels(ray_path >> 4)
+            hit |= (contains(changed, sections) & inside).any(axis=1)
+
+        return hit
+
+    def get_visible(self, x, y, z, pitch, yaw):
+        """ Returns the visible blocks from the given camera pose as
+        (voxels, blockids, metas): an (n, 3) array of block coordinates and
+        two arrays of block IDs and metadata.
+        """
+
+        with self.lock:
+            self.frames += 1
+            self.drain_changes()
+
+            if not self.cache_size:
+                return self.cast(x, y, z, pitch, yaw)
+
+            key = self.round_pose(x, y, z, pitch, yaw)
+            entry = self.cache.get(key)
+
+            if entry is not None:
+                sections, revisions, visible = entry
+                if self.get_revisions(sections) == revisions:
+                    self.cache_hits += 1
+                    del self.cache[key]
+                    self.cache[key] = entry
+                    return visible
+
+                self.drop_cached(key)
+
+            self.cache_misses += 1
+            visible = self.cast(*key)
+
+            # the revisions are read before the blocks, see marked_revision
+            sections, revisions = self.frame_revisions
+            if revisions and max(revisions) > self.marked_revision:
+                return visible
+
+            self.cache[key] = (sections, revisions, visible)
+            self.cache_bytes += (sections.nbytes + 8 * len(revisions) +
+                                 sum(array.nbytes for array in visible))
+
+            while len(self.cache) > self.cache_size:
+                self.drop_cached(next(iter(self.cache)))
+                self.cache_evictions += 1
+
+            return visible
+
+    def round_pose(self, x, y, z, pitch, yaw):
+        """ Rounds a pose to the cache grid. """
+
+        position_step = self.cache_position_step
+        angle_step = self.cache_angle_step
+
+        return (round(x / position_step) * position_step,
+                round(y / position_step) * position_step,
+                round(z / position_step) * position_step,
+                round(pitch / angle_step) * angle_step,
+                round(yaw / angle_step) % round(360. / angle_step) *
+                angle_step)
+
+    def get_revisions(self, sections):
+
+        return tuple(self.get_revision(chunk_x, chunk_z, section_y)
+                     for chunk_x, chunk_z, section_y in sections.tolist())
+
+    def drop_cached(self, key):
+
+        sections, revisions, visible = self.cache.pop(key)
+        self.cache_bytes -= (sections.nbytes + 8 * len(revisions) +
+                             sum(array.nbytes for array in visible))
+
+    def cast(self, x, y, z, pitch, yaw):
+        """ Computes the visible blocks from a pose, casting only the rays
+        that changed since the last frame.
+        """
+
+        pose = (x, y, z, pitch, yaw)
+
+        if (pose == self.pose and not self.changed_blocks and
+                not self.changed_sections):
+            self.rays_reused += len(self.ray_keys)
+            return self.visible
+
+        origins, directions, lengths, band_slices, parents = ray_layout(
+            x, y, z, pitch, yaw, self.bands)
+
+        # every ray gets the same number of steps, so the rays of two frames
+        # can be compared one to one
+        num_rays = len(directions)
+        num_steps = 4 + int(
+            (lengths * np.abs(directions).sum(axis=1)).max())
+
+        path = np.zeros((num_rays, num_steps, 3), dtype=np.int64)
+        inside = np.zeros((num_rays, num_steps), dtype=bool)
+        ray_keys = np.zeros((num_rays, num_steps), dtype=np.int64)
+        ray_ids = np.zeros((num_rays, num_steps), dtype=np.uint16)
+        ray_metas = np.zeros((num_rays, num_steps), dtype=np.uint16)
+        known = np.zeros(num_rays, dtype=bool)
+
+        comparable = (self.ray_keys is not None and
+                      self.ray_keys.shape == ray_keys.shape)
+
+        seen = np.zeros((num_rays, num_steps), dtype=bool)
+        revisions = {}
+
+        # rays that crossed their band without hitting anything solid
+        clear = np.zeros(num_rays, dtype=bool)
+
+        for band in band_slices:
+            if band.start == 0:
+                alive = np.ones(band.stop, dtype=bool)
+            else:
+                alive = clear[parents[band]].any(axis=1)
+
+            rays = band.start + np.flatnonzero(alive)
+            clear[rays] = True
+            if not len(rays):
+                continue
+
+            rays, sections = self.trace(
+                rays, origins, directions, lengths, path, inside)
+            ray_keys[rays] = pack_voxels(path[rays])
+
+            if self.cache_size:
+                # read before any block, see marked_revision
+                for key in map(tuple, sections.tolist()):
+                    if key not in revisions:
+                        revisions[key] = self.get_revision(*key)
+
+            if comparable:
+                same = self.ray_known[rays] & ~(
+                    (ray_keys[rays] != self.ray_keys[rays]) |
+                    (inside[rays] != self.ray_inside[rays])).any(axis=1)
+                same &= ~self.touches_changes(
+                    ray_keys[rays], path[rays], inside[rays])
+
+                reused = rays[same]
+                self.rays_reused += len(reused)
+                ray_ids[reused] = self.ray_ids[reused]
+                ray_metas[reused] = self.ray_metas[reused]
+                known[reused] = True
+                rays = rays[~same]
+
+            if len(rays):
+                ray_ids[rays], ray_metas[rays] = self.look_up(
+                    path[rays], inside[rays], ray_keys[rays])
+                known[rays] = True
+                self.rays_cast += len(rays)
+
+            seen[band] = visible_mask(ray_ids[band], inside[band])
+            clear[band] &= ~(
+                SOLID_BLOCKS[ray_ids[band]] & inside[band]).any(axis=1)
+
+        self.changed_blocks = set()
+        self.changed_sections = set()
+
+        self.ray_keys = ray_keys
+        self.ray_inside = inside
+        self.ray_ids = ray_ids
+        self.ray_metas = ray_metas
+        self.ray_known = known
+
+        if self.cache_size:
+            keys = sorted(revisions)
+            self.frame_revisions = (
+                np.array(keys, dtype=np.int64).reshape(-1, 3),
+                tuple(revisions[key] for key in keys))
+
+        keys, first = np.unique(ray_keys[seen], return_index=True)
+
+        self.pose = pose
+        self.visible = (path[seen][first], ray_ids[seen][first],
+                        ray_metas[seen][first])
+
+        return self.visible
+
+    def trace(self, rays, origins, directions, lengths, path, inside):
+        """ Walks the given rays through the block grid into path and
+        inside. With get_occupancy, a coarse pass over chunk sections comes
+        first: rays that only cross sections of air are not walked at all,
+        and rays are cut at the first section that is all solid.
+
+        Returns:
+            (rays, sections): the rays that were walked, and an (n, 3) array
+            of (chunk_x, chunk_z, section_y) of the sections they cross.
+        """
+
+        lengths = lengths[rays]
+
+        if self.get_occupancy is not None:
+            section_path, section_inside, distance = traverse_rays(
+                origins[rays] / 16., directions[rays], lengths / 16.,
+                entry=True)
+            sections = section_path[:, :, [0, 2, 1]]
+
+            flags = np.full(section_inside.shape, OCCUPANCY_AIR,
+                            dtype=np.uint8)
+            keys, first, inverse = np.unique(
+                pack_voxels(section_path[section_inside]),
+                return_index=True, return_inverse=True)
+            flags[section_inside] = np.asarray(self.get_occupancy(
+                sections[section_inside][first]))[inverse]
+
+            opaque = flags == OCCUPANCY_OPAQUE
+            hit = opaque.any(axis=1)
+            last = np.where(hit, opaque.argmax(axis=1),
+                            section_inside.shape[1])
+            crossed = section_inside & (
+                np.arange(section_inside.shape[1]) <= last[:, np.newaxis])
+
+            # enter the solid section by a hair, so its first block is in
+            index = np.arange(len(rays))
+            entered = distance[index, np.minimum(
+                last, section_inside.shape[1] - 1)]
+            lengths = np.where(hit, entered * 16. + 1e-6, lengths)
+
+            # and start at the first section that is not all air
+            filled = crossed & (flags != OCCUPANCY_AIR)
+            walk = filled.any(axis=1)
+            begin = np.maximum(
+                distance[index, filled.argmax(axis=1)] * 16. - 1e-6, 0.)
+
+            sections = sections[crossed]
+            rays = rays[walk]
+            begin = begin[walk]
+            lengths = lengths[walk] - begin
+            self.rays_skipped += int((~walk).sum())
+        else:
+            begin = 0.
+
+        if len(rays):
+            ray_path, ray_inside = traverse_rays(
+                origins[rays] + directions[rays] * np.reshape(begin, (-1, 1)),
+                directions[rays], lengths)
+            steps = min(ray_path.shape[1], path.shape[1])
+            path[rays, :steps] = ray_path[:, :steps]
+            inside[rays, :steps] = ray_inside[:, :steps]
+
+        if self.get_occupancy is None:
+            sections = path[rays][inside[rays]] >> 4
+            sections = sections[:, [0, 2, 1]]
+
+        return rays, sections
+
+    def look_up(self, path, inside, ray_keys):
+        """ Looks up the blocks along some rays, every block once however
+        many rays cross it. Returns their block IDs and metadata as two
+        arrays shaped like ray_keys.
+        """
+
+        # nothing to look up above or below the world
+        inside = inside & (path[..., 1] >= 0) & (path[..., 1] < 256)
+
+        if self.get_occupancy is not None:
+            inside = self.skip_uniform_sections(path, inside)
+
+        ray_ids = np.zeros(ray_keys.shape, dtype=np.uint16)
+        ray_metas = np.zeros(ray_keys.shape, dtype=np.uint16)
+
+        if not inside.any():
+            return ray_ids, ray_metas
+
+        keys, first, inverse = np.unique(
+            ray_keys[inside], return_index=True, return_inverse=True)
+        voxels = path[inside][first]
+        blockids = np.zeros(len(keys), dtype=np.uint16)
+        metas = np.zeros(len(keys), dtype=np.uint16)
+
+        if self.get_exposed is not None:
+            # buried blocks read as air, they are behind a solid block
+            # anyway. Rays may start inside one, so first blocks are kept
+            wanted = np.asarray(self.get_exposed(
+                voxels[:, 0], voxels[:, 1], voxels[:, 2]), dtype=bool)
+            starts = np.zeros(inside.shape, dtype=bool)
+            starts[:, 0] = True
+            wanted[inverse[starts[inside]]] = True
+            self.blocks_buried += int((~wanted).sum())
+            voxels = voxels[wanted]
+        else:
+            wanted = slice(None)
+
+        blockids[wanted], metas[wanted] = self.get_blocks(
+            voxels[:, 0], voxels[:, 1], voxels[:, 2])
+        self.blocks_looked_up += len(voxels)
+
+        ray_ids[inside] = blockids[inverse]
+        ray_metas[inside] = metas[inverse]
+
+        return ray_ids, ray_metas
+
+    def skip_uniform_sections(self, path, inside):
+        """ Returns the part of inside that still has to be looked up:
+        sections that are all air hold nothing to look up, and a ray ends
+        at its first block in a section that is all solid.
+        """
+
+        sections = path >> 4
+        keys, first, inverse = np.unique(
+            pack_voxels(sections[inside]), return_index=True,
+            return_inverse=True)
+
+        flags = np.full(inside.shape, OCCUPANCY_AIR, dtype=np.uint8)
+        flags[inside] = np.asarray(self.get_occupancy(
+            sections[inside][first][:, [0, 2, 1]]))[inverse]
+
+        opaque = flags == OCCUPANCY_OPAQUE
+        last = np.where(opaque.any(axis=1), opaque.argmax(axis=1),
+                        inside.shape[1])
+
+        needed = (inside & (flags != OCCUPANCY_AIR) &
+                  (np.arange(inside.shape[1]) <= last[:, np.newaxis]))
+        self.steps_skipped += int(inside.sum() - needed.sum())
+
+        return needed
+
+    def get_stats(self):
+        """ Returns the frame, ray, lookup and cache counters as a dict. """
+
+        with self.lock:
+            lookups = self.cache_hits + self.cache_misses
+
+            return {'frames': self.frames,
+                    'rays_cast': self.rays_cast,
+                    'rays_reused': self.rays_reused,
+                    'blocks_looked_up': self.blocks_looked_up,
+                    'steps_skipped': self.steps_skipped,
+                    'rays_skipped': self.rays_skipped,
+                    'blocks_buried': self.blocks_buried,
+                    'cache_hits': self.cache_hits,
+                    'cache_misses': self.cache_misses,
+                    'cache_hit_rate': (float(self.cache_hits) / lookups
+                                       if lookups else 0.),
+                    'cache_evictions': self.cache_evictions,
+                    'cache_entries': len(self.cache),
+                    'cache_bytes': self.cache_bytes}
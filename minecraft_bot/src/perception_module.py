@@ -14,6 +14,8 @@ from atomspace_util import get_predicate, get_most_recent_pred_val
 from ros_perception import ROSPerceptionInterface
 from spockbot.mcdata import blocks
 
+from itertools import repeat
+
 default_map_timestamp = 0
 default_map_name = "MCmap"
 default_map_resolution = 1
@@ -32,7 +34,8 @@ class PerceptionManager:
     def __init__(self, atomspace, space_server, time_server):
         self._handle_dict = {
             "client_position_data": self.handle_self_pos_message,
-            "camera_vis_data": self.handle_vision_message}
+            "camera_vis_data": self.handle_vision_message,
+            "camera_vis_packed": self.handle_packed_vision_message}
         self._receiver = ROSPerceptionInterface(self._handle_dict)
         self._atomspace = atomspace
         self._space_server = space_server
@@ -40,6 +43,8 @@ class PerceptionManager:
         self._space_server.add_map(default_map_timestamp,
                                    default_map_name,
                                    default_map_resolution)
+        # seq of the last vision frame handled, None until a keyframe
+        self._vision_seq = None
 
     def _get_map(self, map_name=default_map_name):
         try:
@@ -60,24 +65,55 @@ class PerceptionManager:
             return None, None
         return er_handle, self._space_server.get_entity_recorder(er_handle)
 
+    def _next_vision_frame(self, data):
+        # A delta frame only holds the blocks that came into view or changed
+        # since the frame before it, so after a missed frame wait for the
+        # next keyframe. Blocks that went out of view (data.removed) stay in
+        # the space map as they were last seen.
+        if not data.keyframe and (
+                self._vision_seq is None or
+                data.seq != (self._vision_seq + 1) & 0xFFFFFFFF):
+            self._vision_seq = None
+            return False
+        self._vision_seq = data.seq
+        return True
+
     def handle_vision_message(self, data):
         # print "handle_visiion_message"
+        if not self._next_vision_frame(data):
+            return
+
         # TODO: In Minecraft the up/down direction is y coord
         # but we should swap y and z in ros node, not here..
-        for block in data.blocks:
-            swap_y_and_z(block)
+        self._handle_visible_blocks(
+            (block.x, block.z, block.y, block.blockid, block.metadata,
+             block.ROStimestamp, block.MCtimestamp) for block in data.blocks)
+
+    def handle_packed_vision_message(self, data):
+        # same as handle_vision_message for map_block_array_msg frames, which
+        # are read straight from their arrays, without a message per block
+        if not self._next_vision_frame(data):
+            return
+
+        # y and z swapped as in handle_vision_message
+        self._handle_visible_blocks(zip(
+            data.x, data.z, data.y, data.blockid, data.metadata,
+            repeat(data.ROStimestamp), repeat(data.MCtimestamp)))
+
+    def _handle_visible_blocks(self, visible_blocks):
+        # visible_blocks yields (x, y, z, blockid, metadata, ROStimestamp,
+        # MCtimestamp) with z pointing up
         material_dict = {}
         map_handle, cur_map = self._get_map()
-        for block in data.blocks:
-            old_block_handle = cur_map.get_block((block.x, block.y, block.z))
+        for x, y, z, blockid, metadata, ros_time, mc_time in visible_blocks:
+            old_block_handle = cur_map.get_block((x, y, z))
             updated_eval_links = []
 
             # Count how many of each block type we have seen during this vision frame.
             # Also store the new block material in case it differs from the existing material.
             # TODO: Use this dict for something or it can be removed, currently
             # it is created and filled up but not used by anything else.
-            block_material = blocks.get_block(
-                    block.blockid, block.metadata).display_name
+            block_material = blocks.get_block(blockid, metadata).display_name
 
             if block_material in material_dict:
                 material_dict[block_material] += 1
@@ -89,7 +125,7 @@ class PerceptionManager:
                 # Create the block in atomspace and set its initial attention
                 # value.
                 blocknode, updated_eval_links = self._build_block_nodes(
-                        block, map_handle)
+                        x, y, z, blockid, metadata, map_handle)
                 # TODO: Make the 200 a constant, this occurs one other place.
 
                 blocknode.av['sti'] = 200
@@ -109,7 +145,7 @@ class PerceptionManager:
                     cur_sti = min(cur_sti + 20, 500)
                     old_block_handle.av['sti'] = cur_sti
                     continue
-                elif block.blockid == 0:
+                elif blockid == 0:
                     # Block used to be solid and is now an air block, remove it
                     # from the atomspace and mark the old block as being
                     # disappeared for attention allocation routine to look at.
@@ -123,8 +159,7 @@ class PerceptionManager:
                     # value does not increase here, but that is ok because this
                     # is rare anyway so skipping an increase is no big deal.
                     blocknode, updated_eval_links = self._build_block_nodes(
-                            block,
-                            map_handle)
+                            x, y, z, blockid, metadata, map_handle)
 
                 disappeared_link = add_predicate(
                         self._atomspace, "disappeared", old_block_handle)
@@ -132,19 +167,13 @@ class PerceptionManager:
 
             # Add the block to the spaceserver and the timeserver.
             self._space_server.add_map_info(blocknode, map_handle, False,
-                                            False,
-                                            block.ROStimestamp,
-                                            block.x, block.y, block.z)
+                                            False, ros_time, x, y, z)
             if old_block_handle == None:
-                self._time_server.add_time_info(
-                        blocknode, block.ROStimestamp, "ROS")
-                self._time_server.add_time_info(
-                        blocknode, block.MCtimestamp, "MC")
+                self._time_server.add_time_info(blocknode, ros_time, "ROS")
+                self._time_server.add_time_info(blocknode, mc_time, "MC")
             for link in updated_eval_links:
-                self._time_server.add_time_info(
-                        link, block.ROStimestamp, "ROS")
-                self._time_server.add_time_info(
-                        link, block.MCtimestamp, "MC")
+                self._time_server.add_time_info(link, ros_time, "ROS")
+                self._time_server.add_time_info(link, mc_time, "MC")
                 # print blocknode
                 # print updated_eval_links
 
@@ -215,7 +244,7 @@ class PerceptionManager:
         updated_eval_links.append(look_link)
         return client_node, updated_eval_links
 
-    def _build_block_nodes(self, block, map_handle):
+    def _build_block_nodes(self, x, y, z, blockid, metadata, map_handle):
 
         # hack to make static object No. variable in class method
         if not hasattr(self._build_block_nodes.__func__, "objNo"):
@@ -230,12 +259,12 @@ class PerceptionManager:
         updated_eval_links = []
 
         at_location_link = add_location(self._atomspace, obj_node, map_handle,
-                                        [block.x, block.y, block.z])
+                                        [x, y, z])
         updated_eval_links.append(at_location_link)
 
         type_node = self._atomspace.add_node(
                 types.ConceptNode, blocks.get_block(
-                        block.blockid, block.metadata).display_name)
+                        blockid, metadata).display_name)
         material_link = add_predicate(self._atomspace, "material",
                                       obj_node, type_node)
         updated_eval_links.append(material_link)
@@ -1,10 +1,12 @@
 import roslib; roslib.load_manifest('minecraft_bot')
 import rospy
 from minecraft_bot.msg import map_block_msg, position_msg, map_block_multi_msg
+from minecraft_bot.msg import map_block_array_msg
 from minecraft_bot.srv import visible_blocks_srv
 
 subscribed_msg_dict = {"client_position_data" : position_msg,
-                       "camera_vis_data" : map_block_multi_msg}
+                       "camera_vis_data" : map_block_multi_msg,
+                       "camera_vis_packed" : map_block_array_msg}
 
 class ROSPerceptionInterface:
     
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Checks the map server (mapnode.py) without Minecraft or a ROS graph
+
+Each check builds a MinecraftMap from bench_mapnode's generated terrain and
+asserts on what it answers. Run with
+
+    rosrun minecraft_bot test_mapnode.py
+
+which prints the name of every check as it passes and stops at the first
+failure.
+"""
+
+import roslib
+roslib.load_manifest('minecraft_bot')
+
+from bench_mapnode import terrain_column
+from mapnode import MinecraftMap, DIMENSION_OVERWORLD, DIMENSION_NETHER
+from std_msgs.msg import Int8
+from mc_chunk_cache import ChunkCache
+from mc_vis_utils import VisibilityEngine, init_block_mats
+
+import shutil
+import tempfile
+
+
+def make_world(radius=1, seed=1, cache=None):
+    """ A map holding the terrain columns within radius chunks of (0, 0),
+    saving them to cache if given.
+    """
+
+    world = MinecraftMap(DIMENSION_OVERWORLD)
+    if cache is not None:
+        world.attach_cache(cache)
+
+    for chunk_x in range(-radius, radius + 1):
+        for chunk_z in range(-radius, radius + 1):
+            world.columns[(chunk_x, chunk_z)] = terrain_column(
+                chunk_x, chunk_z, seed)
+            world.account_column((chunk_x, chunk_z))
+
+    world.commit()
+
+    return world
+
+
+def test_vision_cache_after_restore():
+    """ Poses over columns restored from the chunk cache are cached once
+    the map has made those columns resident.
+    """
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        make_world(cache=ChunkCache(cache_dir)).flush_cache()
+
+        world = MinecraftMap(DIMENSION_OVERWORLD)
+        world.attach_cache(ChunkCache(cache_dir))
+        vision = VisibilityEngine(world.get_blocks,
+                                  get_revision=world.get_revision,
+                                  cache_size=16)
+        world.on_changes = vision.mark_changed
+
+        # the first frame maps the columns in, the commit makes them resident
+        vision.get_visible(8., 80., 8., 30., 45.)
+        world.commit()
+
+        for i in range(4):
+            vision.get_visible(8., 80., 8., 30., 45.)
+
+        stats = vision.get_stats()
+        assert stats['cache_hits'] == 3, stats
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_cache_per_dimension():
+    """ After a respawn in another dimension the map no longer serves the
+    cached columns of the old one, and serves them again on the way back.
+    """
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        world = make_world(cache=ChunkCache(cache_dir))
+        block = world.get_block(5, 64, 5)
+        assert block != (0, 0), block
+
+        world.handle_new_dimension(Int8(DIMENSION_NETHER))
+        assert world.get_block(5, 64, 5) == (0, 0)
+        assert not world.find_nearest_blocks([block[0]], 5, 64, 5)
+
+        world.handle_new_dimension(Int8(DIMENSION_OVERWORLD))
+        assert world.get_block(5, 64, 5) == block
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_find_nearest_large_ids():
+    """ Block IDs that do not fit in 12 bits find nothing instead of
+    failing the search.
+    """
+
+    world = make_world()
+    stone = world.find_nearest_blocks([1], 5, 40, 5)
+
+    assert world.find_nearest_blocks([5000], 5, 40, 5) == []
+    assert world.find_nearest_blocks([1, 4096, 65535], 5, 40, 5) == stone
+
+
+def main():
+
+    init_block_mats()
+
+    for check in (test_vision_cache_after_restore, test_cache_per_dimension,
+                  test_find_nearest_large_ids):
+        check()
+        print("%s passed" % check.__name__)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -6,6 +6,152 @@ import rospy
 import mc_vis_utils as vis
 from minecraft_bot.srv import visible_blocks_srv, get_block_multi_srv
 from minecraft_bot.msg import map_block_msg, position_msg, map_block_multi_msg
+from minecraft_bot.msg import map_block_array_msg
+from minecraft_bot.msg import vec3_msg, map_changes_msg
+
+import numpy as np
+import threading
+import time
+
+# where visibility is computed. 'map' asks the map server for the visible
+# blocks (see mapnode.py), 'local' looks every block along the rays up with
+# get_block_multi and filters them here
+ENGINE_MAP = 'map'
+ENGINE_LOCAL = 'local'
+
+# parameters that only configure the local engine
+LOCAL_ENGINE_PARAMS = ('mode', 'lod', 'angle_step', 'max_dist', 'cache_size')
+
+# what goes on camera_vis_data. 'full' sends every visible block each tick,
+# 'delta' only what changed since the frame before, see FrameEncoder
+PUBLISH_FULL = 'full'
+PUBLISH_DELTA = 'delta'
+
+# message type of the frames. 'blocks' sends map_block_multi_msgs on
+# camera_vis_data, 'packed' sends map_block_array_msgs (parallel arrays, no
+# message per block) on camera_vis_packed
+FORMAT_BLOCKS = 'blocks'
+FORMAT_PACKED = 'packed'
+
+
+class PoseMailbox(object):
+    """ Holds the most recent camera pose until the vision worker takes it.
+    A pose that is replaced before it was taken is dropped, so the worker
+    never falls behind the bot.
+    """
+
+    def __init__(self):
+
+        self.condition = threading.Condition()
+        self.pose = None
+
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, pose):
+
+        with self.condition:
+            if self.pose is not None:
+                self.dropped += 1
+            self.pose = pose
+            self.received += 1
+            self.condition.notify()
+
+    def take(self, timeout):
+        """ Returns the latest pose, waiting up to timeout seconds for one.
+        Returns None if none arrived.
+        """
+
+        with self.condition:
+            if self.pose is None:
+                self.condition.wait(timeout)
+            pose, self.pose = self.pose, None
+            return pose
+
+
+class FrameEncoder(object):
+    """ Turns visible sets into numbered frames in the given message format
+    and, in delta mode, cuts them down to what changed since the frame
+    before: the blocks that came into view or changed, and the positions of
+    those that went out of view. Every keyframe_interval frames, and after
+    a new subscriber connects, a keyframe with the whole set is sent
+    instead, so subscribers that missed a frame can catch up.
+    """
+
+    def __init__(self, mode=PUBLISH_FULL, keyframe_interval=30,
+                 msg_format=FORMAT_BLOCKS):
+
+        self.mode = mode
+        self.keyframe_interval = keyframe_interval
+        self.msg_format = msg_format
+
+        # visible set of the last frame, as (voxels, blockids, metas)
+        self.last = None
+
+        self.frames = 0
+        self.keyframes = 0
+        self.last_keyframe = 0
+        self.blocks_sent = 0
+
+    def request_keyframe(self):
+
+        self.last = None
+
+    def encode(self, voxels, blockids, metas):
+        """ Returns the message of the next frame, given every visible
+        block as (voxels, blockids, metas) like
+        VisibilityEngine.get_visible.
+        """
+
+        self.frames += 1
+        keyframe = True
+        removed = np.zeros((0, 3), dtype=np.int64)
+
+        if self.mode == PUBLISH_DELTA:
+            visible = (voxels, blockids, metas)
+
+            if (self.last is not None and self.frames - self.last_keyframe <
+                    self.keyframe_interval):
+                changed, removed = vis.diff_visible(self.last, visible)
+                keyframe = False
+                voxels = voxels[changed]
+                blockids = blockids[changed]
+                metas = metas[changed]
+
+            self.last = visible
+
+        if keyframe:
+            self.keyframes += 1
+            self.last_keyframe = self.frames
+
+        self.blocks_sent += len(voxels)
+
+        if self.msg_format == FORMAT_PACKED:
+            # visnode never sees the world age, so MCtimestamp stays 0
+            rostime = rospy.Time.now()
+            return map_block_array_msg(
+                ROStimestamp=rostime.secs * 10e9 + rostime.nsecs,
+                MCtimestamp=0, seq=self.frames & 0xFFFFFFFF, keyframe=keyframe,
+                x=voxels[:, 0].tolist(), y=voxels[:, 1].tolist(),
+                z=voxels[:, 2].tolist(), blockid=blockids.tolist(),
+                metadata=metas.tolist(), removed_x=removed[:, 0].tolist(),
+                removed_y=removed[:, 1].tolist(),
+                removed_z=removed[:, 2].tolist())
+
+        return map_block_multi_msg(
+            seq=self.frames & 0xFFFFFFFF, keyframe=keyframe,
+            blocks=vis.make_block_msgs(voxels, blockids, metas),
+            removed=[vec3_msg(x=x, y=y, z=z) for x, y, z in removed.tolist()])
+
+
+class KeyframeOnSubscribe(rospy.SubscribeListener):
+    """ Makes the next frame a keyframe when a node subscribes to the
+    vision frames, so it does not wait for the next periodic one.
+    """
+
+    def peer_subscribe(self, topic_name, topic_publish, peer_publish):
+
+        encoder.request_keyframe()
 
 
 def get_block_multi(coords):
@@ -22,34 +168,200 @@ def get_block_multi(coords):
         print "service call failed: %s" % e
 
 
+def get_blocks(xs, ys, zs):
+    """ Looks blocks up with get_block_multi, for a local VisibilityEngine.
+    """
+
+    coords = [vec3_msg(x=x, y=y, z=z)
+              for x, y, z in zip(xs.tolist(), ys.tolist(), zs.tolist())]
+    blocks = get_block_multi(coords) or []
+
+    blockids = np.array([block.blockid for block in blocks], dtype=np.uint16)
+    metas = np.array([block.metadata for block in blocks], dtype=np.uint16)
+
+    if len(blocks) != len(coords):
+        # the service call failed, treat everything as air
+        blockids = np.zeros(len(coords), dtype=np.uint16)
+        metas = np.zeros(len(coords), dtype=np.uint16)
+
+    return blockids, metas
+
+
+def get_visible_from_map(req):
+    """ Asks the map server to compute the visible blocks itself. Returns
+    them as (voxels, blockids, metas).
+    """
+
+    rospy.wait_for_service('get_visible_blocks')
+
+    try:
+        getVisibleFromSrv = rospy.ServiceProxy(
+            'get_visible_blocks', visible_blocks_srv)
+        response = getVisibleFromSrv(
+            req.x, req.y, req.z, req.pitch, req.yaw, True)
+        return (np.array([response.x, response.y, response.z],
+                         dtype=np.int64).reshape(3, -1).T,
+                np.array(response.blockid, dtype=np.uint16),
+                np.array(response.metadata, dtype=np.uint16))
+
+    except rospy.ServiceException as e:
+        print "service call failed: %s" % e
+        return vis.block_arrays([])
+
+
+def get_revision(chunk_x, chunk_z, section_y):
+    """ Returns the last revision of a section seen on 'map_changes'. """
+
+    return section_revisions.get((chunk_x, chunk_z, section_y), 0)
+
+
+def handle_map_changes(msg):
+    """ Passes the map server's change batches on to the local engine, so it
+    only re-casts the rays that cross changed blocks.
+    """
+
+    for section in msg.sections:
+        section_revisions[(section.chunk_x, section.chunk_z,
+                           section.section_y)] = section.revision
+
+    local_engine.mark_changed([
+        ((section.chunk_x, section.chunk_z, section.section_y),
+         section.revision,
+         None if section.full else [(block.x, block.y, block.z)
+                                    for block in section.blocks])
+        for section in msg.sections])
+
+
 def handle_get_visible_blocks(req):
 
-    coords = vis.get_coordinates_in_range(
-        req.x, req.y, req.z, req.pitch, req.yaw)
-    blocks = get_block_multi(coords)
-    vis_blocks = vis.get_visible_blocks(blocks)
+    if vis_engine == ENGINE_MAP:
+        visible = get_visible_from_map(req)
+    elif vis_mode == vis.MODE_DDA:
+        visible = local_engine.get_visible(
+            req.x, req.y, req.z, req.pitch, req.yaw)
+    else:
+        coords = vis.get_coordinates_in_range(
+            req.x, req.y, req.z, req.pitch, req.yaw)
+        blocks = get_block_multi(coords)
+        visible = vis.block_arrays(vis.get_visible_blocks(blocks))
+
+    msg = encoder.encode(*visible)
+
+    if encoder.msg_format == FORMAT_PACKED:
+        packed_pub.publish(msg)
+    else:
+        block_pub.publish(msg)
+
+
+def vision_worker(min_interval):
+    """ Computes visibility for the latest pose in the mailbox, at most once
+    every min_interval seconds, until ROS shuts down.
+    """
 
-    block_pub.publish(vis_blocks)
+    last = 0.
+
+    while not rospy.is_shutdown():
+        wait = last + min_interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        pose = mailbox.take(0.5)
+        if pose is None:
+            continue
+
+        last = time.time()
+
+        # a failed frame must not stop the worker, the next pose may work
+        try:
+            handle_get_visible_blocks(pose)
+        except Exception as e:
+            rospy.logerr("visibility for pose failed: %s", e)
+
+
+def log_vision_stats(event):
+
+    rospy.loginfo("visibility: %d poses received, %d dropped, %d frames "
+                  "published (%d keyframes, %d blocks)",
+                  mailbox.received, mailbox.dropped, encoder.frames,
+                  encoder.keyframes, encoder.blocks_sent)
 
 
 def visible_blocks_node():
 
+    global vis_engine, vis_mode, local_engine, encoder
+
     vis.init_block_mats()
 
     rospy.init_node('visibility_node')
+
+    vis_engine = rospy.get_param('~engine', ENGINE_MAP)
+    vis_mode = rospy.get_param('~mode', vis.MODE_DDA)
+
+    # the map server casts with its own _vision_* parameters
+    if vis_engine == ENGINE_MAP:
+        ignored = [name for name in LOCAL_ENGINE_PARAMS
+                   if rospy.has_param('~' + name)]
+        if ignored:
+            rospy.logwarn("_%s only apply with _engine:=local, set the map "
+                          "server's _vision_* parameters instead",
+                          ", _".join(ignored))
+
+    lod = rospy.get_param('~lod', False)
+    local_engine = vis.VisibilityEngine(
+        get_blocks, float(rospy.get_param('~angle_step', vis.D_PITCH)),
+        float(rospy.get_param('~max_dist',
+                              vis.LOD_MAX_DIST if lod else vis.MAX_DIST)),
+        get_revision=get_revision,
+        cache_size=rospy.get_param('~cache_size', 256),
+        lod=lod)
+    encoder = FrameEncoder(rospy.get_param('~publish', PUBLISH_FULL),
+                           rospy.get_param('~keyframe_interval', 30),
+                           rospy.get_param('~format', FORMAT_BLOCKS))
+
+    # poses go through the mailbox, so only the latest one is worked on
     rospy.Subscriber(
         'camera_position_data',
         position_msg,
-        handle_get_visible_blocks)
+        mailbox.put)
+
+    worker = threading.Thread(
+        target=vision_worker,
+        args=(float(rospy.get_param('~min_interval', 0.)),))
+    worker.daemon = True
+    worker.start()
+
+    rospy.Timer(rospy.Duration(rospy.get_param('~stats_period', 60.)),
+                log_vision_stats)
+
+    if vis_engine == ENGINE_LOCAL:
+        rospy.Subscriber('map_changes', map_changes_msg, handle_map_changes)
 
     print("visibility node initialized")
 
     rospy.spin()
 
 
+# see visible_blocks_node() for the ROS parameters
+vis_engine = ENGINE_MAP
+vis_mode = vis.MODE_DDA
+local_engine = vis.VisibilityEngine(get_blocks)
+encoder = FrameEncoder()
+
+# (chunk_x, chunk_z, section_y) -> revision, from 'map_changes'
+section_revisions = {}
+
+mailbox = PoseMailbox()
+
 block_pub = rospy.Publisher(
     'camera_vis_data',
     map_block_multi_msg,
+    subscriber_listener=KeyframeOnSubscribe(),
+    queue_size=100)
+
+packed_pub = rospy.Publisher(
+    'camera_vis_packed',
+    map_block_array_msg,
+    subscriber_listener=KeyframeOnSubscribe(),
     queue_size=100)
 
 if __name__ == "__main__":
@@ -2,5 +2,7 @@
 # ! /usr/bin/env python2.7 python2 python
 __author__ = "Karan Desai"
 
-__all__ = ["abs_move_srv", "dig_srv", "get_block_multi_srv", "get_block_srv",
-           "look_srv", "rel_move_srv", "visible_blocks_srv"]
+__all__ = ["abs_move_srv", "dig_srv", "find_nearest_blocks_srv",
+           "get_block_multi_srv", "get_block_region_srv", "get_block_srv",
+           "get_map_stats_srv", "get_surface_srv", "look_srv", "rel_move_srv",
+           "visible_blocks_srv"]
@@ -19,6 +19,7 @@ from minecraft_bot.msg import entity_msg, entity_exp_meta, entity_global_meta, e
 from minecraft_bot.msg import entity_movement_meta, entity_object_meta, entity_painting_meta, entity_player_meta
 
 from minecraft_bot.msg import position_msg
+from std_msgs.msg import Empty, Int8
 
 from spockbot import mcdata
 from spockbot.plugins.base import PluginBase, pl_announce
@@ -48,6 +49,8 @@ class SpockControlPlugin(PluginBase):
 	'ros_chunk_data': 'sendChunkData',
 	'ros_chunk_bulk': 'sendChunkBulk',
 	'ros_block_update': 'sendBlockUpdate',
+	'ros_world_reset': 'sendWorldReset',
+        'ros_new_dimension': 'sendNewDimension',
 	'ros_entity_data': 'sendEntityData',
 	'client_death': 'sendClientDeathUpdate',
         'ros_position_update': 'sendClientPositionUpdate',
@@ -128,6 +131,11 @@ class SpockControlPlugin(PluginBase):
             'block_data', block_data_msg, queue_size=1000)
         self.pub_bulk = rospy.Publisher(
             'chunk_bulk', chunk_bulk_msg, queue_size=1000)
+        self.pub_world_reset = rospy.Publisher(
+            'world_reset', Empty, queue_size=1)
+        # latched, so a map server started later still learns the dimension
+        self.pub_dimension = rospy.Publisher(
+            'dimension', Int8, queue_size=1, latch=True)
         #self.pub_wstate =    rospy.Publisher('world_state', world_state_msg, queue_size = 1)
         self.pub_entity = rospy.Publisher(
             'entity_data', entity_msg, queue_size=100)
@@ -232,9 +240,16 @@ class SpockControlPlugin(PluginBase):
                        msg.data, msg.x, msg.y, msg.z)
         self.pub_block.publish(msg)
 
-    # def sendWorldReset(self, name, data):
-    #
-    #    pub_wstate.publish(data)
+    def sendWorldReset(self, name, data):
+
+        # the map server drops every column it holds
+        self.pub_world_reset.publish(Empty())
+
+    def sendNewDimension(self, name, data):
+
+        # sent on every join and respawn, the map server switches its columns
+        # (and chunk cache lookups) when the dimension changes
+        self.pub_dimension.publish(Int8(data))
 
     def sendEntityData(self, name, data):
 